@@ -7,7 +7,9 @@ const crypto = require('crypto');
 const Docker = require('dockerode');
 const path = require('path');
 const fs = require('fs').promises;
-const { existsSync, mkdirSync, createReadStream, chownSync, readdirSync, statSync, lstatSync } = require('fs');
+const { existsSync, mkdirSync, createReadStream, createWriteStream, chownSync, readdirSync, statSync, lstatSync } = require('fs');
+const { Readable } = require('stream');
+const { pipeline } = require('stream/promises');
 const { execFile } = require('child_process');
 const { promisify } = require('util');
 const execFileAsync = promisify(execFile);
@@ -43,6 +45,9 @@ const OPENCLAW_IMAGE = process.env.OPENCLAW_IMAGE || 'openclaw:local';
 const HOST_PROJECT_DIR = process.env.HOST_PROJECT_DIR || process.cwd();
 const CLIENTS_DIR = path.resolve(process.env.CLIENTS_DIR || path.join(__dirname, 'clients'));
 const CONFIG_TEMPLATE = path.resolve(process.env.CONFIG_TEMPLATE || path.join(__dirname, 'config', 'openclaw.json'));
+const MEMU_API_URL = process.env.MEMU_API_URL || 'http://172.17.0.1:8000';
+// 客户导出包中的 memU 数据文件（Bot 的 memU user_id 即客户名）
+const MEMU_EXPORT_FILE = 'memu-export.ndjson.gz';
 
 // Basic Auth 配置
 const ADMIN_USER = process.env.ADMIN_USER || 'admin';
@@ -226,40 +231,135 @@ async function listClients() {
 
 // ── 用量统计 ──────────────────────────────────────────────
 
-// 从 JSONL 会话文件中解析用量数据
-async function parseSessionUsage(clientName) {
-  const sessionsDir = path.join(CLIENTS_DIR, clientName, 'data', 'agents', 'main', 'sessions');
-  if (!existsSync(sessionsDir)) return {};
+// 增量用量索引：按客户、按会话文件记录已解析到的字节偏移和按天汇总，
+// 每次请求只 stat 文件并解析新追加的行；文件被截断/替换时重新解析该文件，被删除时移除其汇总
+const USAGE_READ_CHUNK = 4 * 1024 * 1024;
+const usageIndex = new Map(); // clientName -> { files: Map<file, { ino, offset, daily }> }
+const usageRefreshing = new Map(); // clientName -> 正在进行的刷新 Promise
 
-  const files = await fs.readdir(sessionsDir);
-  const jsonlFiles = files.filter(f => f.endsWith('.jsonl'));
+function emptyUsage() {
+  return { input: 0, output: 0, cacheRead: 0, totalTokens: 0, requests: 0 };
+}
 
-  // 按天汇总用量
-  const daily = {};
+function addUsage(target, src) {
+  target.input += src.input;
+  target.output += src.output;
+  target.cacheRead += src.cacheRead;
+  target.totalTokens += src.totalTokens;
+  target.requests += src.requests;
+}
 
-  for (const file of jsonlFiles) {
+// 解析一行会话记录，累加到该文件的按天汇总
+function accumulateLine(daily, line) {
+  if (!line.trim()) return;
+  try {
+    const entry = JSON.parse(line);
+    if (entry.type !== 'message' || entry.message?.role !== 'assistant') return;
+    const usage = entry.message?.usage;
+    if (!usage) return;
+
+    const day = entry.timestamp?.slice(0, 10) || 'unknown';
+    if (!daily[day]) daily[day] = emptyUsage();
+    daily[day].input += usage.input || 0;
+    daily[day].output += usage.output || 0;
+    daily[day].cacheRead += usage.cacheRead || 0;
+    daily[day].totalTokens += usage.totalTokens || 0;
+    daily[day].requests += 1;
+  } catch { /* 跳过无法解析的行 */ }
+}
+
+// 从 state.offset 读到文件末尾，只消费完整的行（末尾未写完的行留到下次）
+async function readAppended(filePath, state, size) {
+  const fh = await fs.open(filePath, 'r');
+  try {
+    const buf = Buffer.alloc(Math.min(USAGE_READ_CHUNK, size - state.offset));
+    const carry = [];
+    let carryLen = 0;
+    while (state.offset < size) {
+      const { bytesRead } = await fh.read(buf, 0, Math.min(buf.length, size - state.offset), state.offset);
+      if (!bytesRead) break;
+      const lastNewline = buf.lastIndexOf(0x0a, bytesRead - 1);
+      if (lastNewline < 0) {
+        if (state.offset + bytesRead >= size) {
+          // 文件末尾没有换行的最后一行：已是完整 JSON 则计入（之后补上的换行只产生空行），否则等下次
+          const tail = Buffer.concat([...carry, buf.subarray(0, bytesRead)]).toString('utf-8');
+          try { JSON.parse(tail); } catch { break; }
+          accumulateLine(state.daily, tail);
+          state.offset += bytesRead;
+          carry.length = 0;
+          carryLen = 0;
+          break;
+        }
+        // 单行超过块大小，累积起来
+        carry.push(Buffer.from(buf.subarray(0, bytesRead)));
+        carryLen += bytesRead;
+        state.offset += bytesRead;
+        continue;
+      }
+      const text = Buffer.concat([...carry, buf.subarray(0, lastNewline)]).toString('utf-8');
+      carry.length = 0;
+      carryLen = 0;
+      for (const line of text.split('\n')) accumulateLine(state.daily, line);
+      state.offset += lastNewline + 1;
+    }
+    // 超长行未写完时回退到行首，下次重新读
+    state.offset -= carryLen;
+  } finally {
+    await fh.close();
+  }
+}
+
+async function refreshUsageIndex(clientName, sessionsDir) {
+  let index = usageIndex.get(clientName);
+  if (!index) {
+    index = { files: new Map() };
+    usageIndex.set(clientName, index);
+  }
+
+  const files = (await fs.readdir(sessionsDir)).filter(f => f.endsWith('.jsonl'));
+  const seen = new Set(files);
+  for (const file of index.files.keys()) {
+    if (!seen.has(file)) index.files.delete(file);
+  }
+
+  for (const file of files) {
+    const filePath = path.join(sessionsDir, file);
     try {
-      const content = await fs.readFile(path.join(sessionsDir, file), 'utf-8');
-      for (const line of content.split('\n')) {
-        if (!line.trim()) continue;
-        try {
-          const entry = JSON.parse(line);
-          if (entry.type !== 'message' || entry.message?.role !== 'assistant') continue;
-          const usage = entry.message?.usage;
-          if (!usage) continue;
-
-          const day = entry.timestamp?.slice(0, 10) || 'unknown';
-          if (!daily[day]) daily[day] = { input: 0, output: 0, cacheRead: 0, totalTokens: 0, requests: 0 };
-          daily[day].input += usage.input || 0;
-          daily[day].output += usage.output || 0;
-          daily[day].cacheRead += usage.cacheRead || 0;
-          daily[day].totalTokens += usage.totalTokens || 0;
-          daily[day].requests += 1;
-        } catch { /* 跳过无法解析的行 */ }
+      const st = await fs.stat(filePath);
+      let state = index.files.get(file);
+      if (!state || st.ino !== state.ino || st.size < state.offset) {
+        state = { ino: st.ino, offset: 0, daily: {} };
+        index.files.set(file, state);
       }
+      if (st.size > state.offset) await readAppended(filePath, state, st.size);
     } catch { /* 跳过无法读取的文件 */ }
   }
+  return index;
+}
+
+// 从 JSONL 会话文件中解析用量数据（增量），返回按天汇总
+async function parseSessionUsage(clientName) {
+  const sessionsDir = path.join(CLIENTS_DIR, clientName, 'data', 'agents', 'main', 'sessions');
+  if (!existsSync(sessionsDir)) {
+    usageIndex.delete(clientName);
+    return {};
+  }
 
+  // 同一客户的并发请求共用一次刷新，避免重复读同一段文件
+  let pending = usageRefreshing.get(clientName);
+  if (!pending) {
+    pending = refreshUsageIndex(clientName, sessionsDir).finally(() => usageRefreshing.delete(clientName));
+    usageRefreshing.set(clientName, pending);
+  }
+  const index = await pending;
+
+  const daily = {};
+  for (const state of index.files.values()) {
+    for (const [day, usage] of Object.entries(state.daily)) {
+      if (!daily[day]) daily[day] = emptyUsage();
+      addUsage(daily[day], usage);
+    }
+  }
   return daily;
 }
 
@@ -268,8 +368,8 @@ async function getTodayUsage(clientName) {
   try {
     const daily = await parseSessionUsage(clientName);
     const today = new Date().toISOString().slice(0, 10);
-    return daily[today] || { input: 0, output: 0, cacheRead: 0, totalTokens: 0, requests: 0 };
-  } catch { return { input: 0, output: 0, cacheRead: 0, totalTokens: 0, requests: 0 }; }
+    return daily[today] || emptyUsage();
+  } catch { return emptyUsage(); }
 }
 
 // ── API 路由 ──────────────────────────────────────────────
@@ -293,14 +393,8 @@ app.get('/api/clients/:name/usage', async (req, res) => {
   try {
     const daily = await parseSessionUsage(req.params.name);
     // 计算总计
-    const total = { input: 0, output: 0, cacheRead: 0, totalTokens: 0, requests: 0 };
-    for (const day of Object.values(daily)) {
-      total.input += day.input;
-      total.output += day.output;
-      total.cacheRead += day.cacheRead;
-      total.totalTokens += day.totalTokens;
-      total.requests += day.requests;
-    }
+    const total = emptyUsage();
+    for (const day of Object.values(daily)) addUsage(total, day);
     res.json({ daily, total });
   } catch (e) { res.status(500).json({ error: e.message }); }
 });
@@ -642,7 +736,27 @@ app.delete('/api/clients/:name', async (req, res) => {
 
 // ── 导入导出 API ─────────────────────────────────────────
 
-// 导出客户（完整 data 目录 + .env）为 tar.gz
+// 从 memU 流式导出客户记忆（含向量）到文件
+async function exportMemu(name, file) {
+  const r = await fetch(`${MEMU_API_URL}/export/${encodeURIComponent(name)}?gzip=1`);
+  if (!r.ok) throw new Error(`memU 导出失败: HTTP ${r.status}`);
+  await pipeline(Readable.fromWeb(r.body), createWriteStream(file));
+}
+
+// 将导出文件流式导入 memU（服务端 COPY 批量写入，无需重新 embedding）
+async function importMemu(name, file) {
+  const r = await fetch(`${MEMU_API_URL}/import/${encodeURIComponent(name)}`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/gzip' },
+    body: createReadStream(file),
+    duplex: 'half',
+  });
+  const data = await r.json().catch(() => ({}));
+  if (!r.ok) throw new Error(`memU 导入失败: ${data.detail || `HTTP ${r.status}`}`);
+  return data.result;
+}
+
+// 导出客户（完整 data 目录 + .env + memU 记忆）为 tar.gz
 app.get('/api/clients/:name/export', async (req, res) => {
   try {
     const { name } = req.params;
@@ -657,6 +771,15 @@ app.get('/api/clients/:name/export', async (req, res) => {
     };
     await fs.writeFile(path.join(clientDir, 'meta.json'), JSON.stringify(meta, null, 2));
 
+    // memU 记忆一并打包（memU 不可用时仅导出客户目录）
+    const memuFile = path.join(clientDir, MEMU_EXPORT_FILE);
+    try {
+      await exportMemu(name, memuFile);
+    } catch (e) {
+      console.error(`⚠️ ${name} memU 记忆未导出:`, e.message);
+      try { await fs.unlink(memuFile); } catch { }
+    }
+
     // 流式输出 tar.gz
     res.setHeader('Content-Type', 'application/gzip');
     res.setHeader('Content-Disposition', `attachment; filename="${name}-export.tar.gz"`);
@@ -666,8 +789,9 @@ app.get('/api/clients/:name/export', async (req, res) => {
     tar.stdout.pipe(res);
     tar.stderr.on('data', (d) => console.error('tar stderr:', d.toString()));
     tar.on('close', async (code) => {
-      // 清理 meta.json
+      // 清理 meta.json 和 memU 导出文件
       try { await fs.unlink(path.join(clientDir, 'meta.json')); } catch { }
+      try { await fs.unlink(memuFile); } catch { }
       if (code !== 0 && !res.headersSent) {
         res.status(500).json({ error: 'tar 打包失败' });
       }
@@ -718,6 +842,18 @@ app.post('/api/clients/import', upload.single('file'), async (req, res) => {
     // 清理临时文件
     try { await fs.rm(tmpDir, { recursive: true, force: true }); } catch { }
     try { await fs.unlink(path.join(clientDir, 'meta.json')); } catch { }
+
+    // 导入 memU 记忆（导入到新客户名下）
+    let memu = null;
+    const memuFile = path.join(clientDir, MEMU_EXPORT_FILE);
+    if (existsSync(memuFile)) {
+      try {
+        memu = await importMemu(newName, memuFile);
+      } catch (e) {
+        memu = { error: e.message };
+      }
+      try { await fs.unlink(memuFile); } catch { }
+    }
     // 修正权限（admin 以 root 运行，客户容器需要 uid 1000）
     chownRecursiveSync(clientDir);
 
@@ -738,7 +874,7 @@ app.post('/api/clients/import', upload.single('file'), async (req, res) => {
     });
     await container.start();
 
-    res.status(201).json({ name: newName, port: newPort, status: 'running', message: '导入成功' });
+    res.status(201).json({ name: newName, port: newPort, status: 'running', message: '导入成功', memu });
   } catch (e) {
     res.status(500).json({ error: e.message });
   } finally {
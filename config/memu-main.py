@@ -3,17 +3,32 @@
 Hybrid 方案：Zhipu GLM-4.5-Air 做 ALL chat 调用，Ollama 做 embedding
 """
 
+import asyncio
+import base64
+import contextlib
+import hashlib
+import inspect
 import json
 import os
+import queue
+import re
+import sys
+import threading
+import time
 import traceback
+import unicodedata
 import uuid
+import zlib
+from collections import OrderedDict
+from contextvars import ContextVar
 from pathlib import Path
 from typing import Any, Dict
 
 import httpx
+import numpy as np
 from openai import AsyncOpenAI
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from memu.app import MemoryService
 
 app = FastAPI()
@@ -75,6 +90,7 @@ async def _zhipu_summarize(self, text, *, max_tokens=None, system_prompt=None):
         messages=messages,
         temperature=1,
         max_tokens=max_tokens,
+        extra_headers=_trace_headers(),
     )
     return response.choices[0].message.content or ""
 
@@ -83,6 +99,1371 @@ service.openai.summarize = types.MethodType(_zhipu_summarize, service.openai)
 
 print(f"✅ Hybrid 配置完成: summarize → Zhipu, chat fallback → Ollama, embedding → Ollama")
 
+# ===== 请求追踪 =====
+# skill 脚本通过 W3C traceparent 头传入 trace id（没有则在此生成），请求内的 summarize / embed / 存储 / 检索
+# 记录为带父子关系的 span，以 Chrome Trace Event 格式追加写入 MEMU_TRACE_FILE，可直接用 ui.perfetto.dev 打开。
+# 采样按 trace id 哈希决定，同一 trace 的多次请求要么全部记录、要么全部跳过。
+# 未设置 MEMU_TRACE_FILE 时不注册中间件、不包装 LLM client；写文件由后台线程批量完成，不阻塞事件循环。
+trace_file = os.getenv("MEMU_TRACE_FILE", "")  # 留空 = 关闭
+trace_sample_rate = float(os.getenv("MEMU_TRACE_SAMPLE_RATE", "1.0"))
+_TRACEPARENT_RE = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+_trace_ctx: ContextVar[Dict[str, Any] | None] = ContextVar("memu_trace", default=None)
+
+
+def _trace_headers() -> Dict[str, str]:
+    """向上游模型透传当前 span 的 traceparent"""
+    ctx = _trace_ctx.get()
+    if ctx is None:
+        return {}
+    return {"traceparent": f"00-{ctx['trace_id']}-{ctx['span_id']}-{'01' if ctx['sampled'] else '00'}"}
+
+
+def _trace_sampled(trace_id: str) -> bool:
+    return bool(trace_file) and int(trace_id[:8], 16) / 0xFFFFFFFF < trace_sample_rate
+
+
+_trace_queue: "queue.SimpleQueue[list | None]" = queue.SimpleQueue()
+_trace_writer: threading.Thread | None = None
+
+
+def _write_trace_events(events: list) -> None:
+    # JSON Array 格式允许省略结尾的 ]，各 worker 以 O_APPEND 整行追加即可
+    try:
+        fd = os.open(trace_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        os.write(fd, b"[\n")
+        os.close(fd)
+    except FileExistsError:
+        pass
+    data = "".join(json.dumps(e, ensure_ascii=False) + ",\n" for e in events).encode("utf-8")
+    fd = os.open(trace_file, os.O_WRONLY | os.O_APPEND)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+
+def _trace_writer_loop() -> None:
+    """后台线程：取出队列中已积累的全部 span，一次写入；收到 None 时写完剩余部分后退出"""
+    while True:
+        batch = _trace_queue.get()
+        stop = batch is None
+        events = batch or []
+        while True:
+            try:
+                more = _trace_queue.get_nowait()
+            except queue.Empty:
+                break
+            if more is None:
+                stop = True
+            else:
+                events.extend(more)
+        if events:
+            try:
+                _write_trace_events(events)
+            except OSError:
+                traceback.print_exc()
+        if stop:
+            return
+
+
+def _start_trace_writer() -> None:
+    global _trace_writer
+    if _trace_writer is None:
+        _trace_writer = threading.Thread(target=_trace_writer_loop, name="memu-trace-writer", daemon=True)
+        _trace_writer.start()
+
+
+def _stop_trace_writer() -> None:
+    global _trace_writer
+    if _trace_writer is not None:
+        _trace_queue.put(None)
+        _trace_writer.join(timeout=5)
+        _trace_writer = None
+
+
+def _emit_span(ctx: Dict[str, Any], span_id: str, name: str, start: float, end: float, attrs: Dict[str, Any]) -> None:
+    # 每个 trace 一条轨道（tid），首个 span 时写入轨道名
+    tid = int(ctx["trace_id"][:8], 16) & 0x7FFFFFFF
+    events = []
+    if not ctx["track"]["named"]:
+        ctx["track"]["named"] = True
+        events.append({"ph": "M", "name": "thread_name", "pid": os.getpid(), "tid": tid,
+                       "args": {"name": f"trace {ctx['trace_id']}"}})
+    events.append({
+        "ph": "X",
+        "name": name,
+        "cat": name.split(".")[0],
+        "pid": os.getpid(),
+        "tid": tid,
+        "ts": int(start * 1e6),
+        "dur": int((end - start) * 1e6),
+        "args": dict(attrs, trace_id=ctx["trace_id"], span_id=span_id, parent_id=ctx["span_id"]),
+    })
+    _trace_queue.put(events)
+
+
+@contextlib.asynccontextmanager
+async def _span(name: str, **attrs):
+    """记录一个子 span；yield 出的 dict 可在 span 内补充属性"""
+    ctx = _trace_ctx.get()
+    if ctx is None or not ctx["sampled"]:
+        yield attrs
+        return
+    span_id = os.urandom(8).hex()
+    token = _trace_ctx.set(dict(ctx, span_id=span_id))
+    start = time.time()
+    try:
+        yield attrs
+    except BaseException as exc:
+        attrs["error"] = type(exc).__name__
+        raise
+    finally:
+        _trace_ctx.reset(token)
+        _emit_span(ctx, span_id, name, start, time.time(), attrs)
+
+
+def _traced(name: str, fn):
+    """包装 memU LLM client 上的异步方法"""
+    async def wrapper(*args, **kwargs):
+        async with _span(name):
+            return await fn(*args, **kwargs)
+
+    return wrapper
+
+
+async def _trace_requests(request: Request, call_next):
+    match = _TRACEPARENT_RE.match(request.headers.get("traceparent", ""))
+    trace_id, parent_id = match.groups() if match else (os.urandom(16).hex(), "0" * 16)
+    sampled = _trace_sampled(trace_id)
+    # track 在所有子 span 的上下文间共享（浅拷贝），用于只写一次轨道名
+    root = {"trace_id": trace_id, "span_id": parent_id, "sampled": sampled, "track": {"named": False}}
+    _trace_ctx.set(root)
+    async with _span(f"{request.method} {request.url.path}") as attrs:
+        response = await call_next(request)
+        attrs["status"] = response.status_code
+    response.headers["traceparent"] = f"00-{trace_id}-{parent_id}-{'01' if sampled else '00'}"
+    return response
+
+
+if trace_file:
+    for _method, _span_name in (("embed", "embed.memu"), ("chat", "llm.ollama_chat"), ("summarize", "llm.summarize")):
+        if hasattr(service.openai, _method):
+            setattr(service.openai, _method, _traced(_span_name, getattr(service.openai, _method)))
+    app.middleware("http")(_trace_requests)
+    app.router.add_event_handler("startup", _start_trace_writer)
+    app.router.add_event_handler("shutdown", _stop_trace_writer)
+
+
+# ===== 跨 worker 共享状态 =====
+# 多 worker（MEMU_WORKERS>1）时缓存、计数器、锁必须放在进程外（Redis），否则每个 worker 各看各的
+# 未配置 REDIS_URL 时退化为进程内实现，仅适用于单 worker
+redis_url = os.getenv("REDIS_URL", "")
+
+
+class LocalState:
+    """进程内实现（单 worker）"""
+
+    def __init__(self):
+        self._data: Dict[str, Any] = {}
+        self._expires: Dict[str, float] = {}
+
+    def _alive(self, key: str) -> bool:
+        exp = self._expires.get(key)
+        if exp is not None and exp <= time.time():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return key in self._data
+
+    def _touch(self, key: str, ttl: float | None) -> None:
+        if ttl:
+            self._expires[key] = time.time() + ttl
+        else:
+            self._expires.pop(key, None)
+
+    async def get(self, key: str) -> str | None:
+        return self._data[key] if self._alive(key) else None
+
+    async def set(self, key: str, value: str, ttl: float | None = None) -> None:
+        self._data[key] = value
+        self._touch(key, ttl)
+
+    async def delete(self, *keys: str) -> None:
+        for key in keys:
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+
+    async def incr(self, key: str, ttl: float | None = None) -> int:
+        """自增计数；ttl 只在 key 首次创建时设置（固定窗口计数）"""
+        fresh = not self._alive(key)
+        self._data[key] = int(self._data.get(key, 0)) + 1
+        if fresh:
+            self._touch(key, ttl)
+        return self._data[key]
+
+    async def try_lock(self, key: str, ttl: float, owner: str = "1") -> bool:
+        if self._alive(key):
+            return False
+        await self.set(key, owner, ttl)
+        return True
+
+    async def extend_lock(self, key: str, owner: str, ttl: float) -> bool:
+        """仍由 owner 持有时延长锁的 TTL"""
+        if not self._alive(key) or self._data[key] != owner:
+            return False
+        self._touch(key, ttl)
+        return True
+
+    async def release_lock(self, key: str, owner: str) -> None:
+        """只释放自己持有的锁（锁已过期并被其他 worker 取得时不删除）"""
+        if self._alive(key) and self._data[key] == owner:
+            await self.delete(key)
+
+    async def footprint(self, prefix: str) -> Dict[str, int]:
+        """统计前缀下的 key 数与近似占用字节数"""
+        keys = [k for k in list(self._data) if k.startswith(prefix) and self._alive(k)]
+        return {"keys": len(keys), "bytes": sum(len(k) + len(str(self._data[k])) for k in keys)}
+
+
+class RedisState:
+    """Redis 实现（多 worker / 多容器共享）"""
+
+    # 比较 owner 后再续期 / 删除，两步在 Redis 内原子执行
+    _EXTEND_LUA = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) end return 0"
+    _RELEASE_LUA = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+    def __init__(self, url: str):
+        import redis.asyncio as aioredis
+
+        self._r = aioredis.from_url(url, decode_responses=True)
+
+    async def get(self, key: str) -> str | None:
+        return await self._r.get(key)
+
+    async def set(self, key: str, value: str, ttl: float | None = None) -> None:
+        await self._r.set(key, value, px=int(ttl * 1000) if ttl else None)
+
+    async def delete(self, *keys: str) -> None:
+        if keys:
+            await self._r.delete(*keys)
+
+    async def incr(self, key: str, ttl: float | None = None) -> int:
+        value = await self._r.incr(key)
+        if value == 1 and ttl:
+            await self._r.pexpire(key, int(ttl * 1000))
+        return value
+
+    async def try_lock(self, key: str, ttl: float, owner: str = "1") -> bool:
+        return bool(await self._r.set(key, owner, px=int(ttl * 1000), nx=True))
+
+    async def extend_lock(self, key: str, owner: str, ttl: float) -> bool:
+        return bool(await self._r.eval(self._EXTEND_LUA, 1, key, owner, int(ttl * 1000)))
+
+    async def release_lock(self, key: str, owner: str) -> None:
+        await self._r.eval(self._RELEASE_LUA, 1, key, owner)
+
+    # footprint 最多对这么多个 key 取 MEMORY USAGE，其余按平均值外推
+    FOOTPRINT_SAMPLE = 1000
+
+    async def footprint(self, prefix: str) -> Dict[str, int]:
+        """统计前缀下的 key 数（SCAN，不阻塞 Redis）与占用字节数（抽样 MEMORY USAGE，一次 pipeline 往返后外推）"""
+        keys, sample = 0, []
+        async for key in self._r.scan_iter(match=f"{prefix}*", count=1000):
+            keys += 1
+            if len(sample) < self.FOOTPRINT_SAMPLE:
+                sample.append(key)
+        if not sample:
+            return {"keys": 0, "bytes": 0}
+        async with self._r.pipeline(transaction=False) as pipe:
+            for key in sample:
+                pipe.memory_usage(key)
+            sizes = [size or 0 for size in await pipe.execute()]
+        return {"keys": keys, "bytes": int(sum(sizes) / len(sizes) * keys)}
+
+
+shared = RedisState(redis_url) if redis_url else LocalState()
+print(f"   Shared state: {'redis ' + redis_url if redis_url else 'in-process（单 worker）'}")
+
+# 不带用户范围的请求（与升级前行为一致：memorize 不写 user_id，retrieve 检索全部记忆）在缓存键等处的占位名
+UNSCOPED = "*"
+
+
+# 每用户 memorize 限流（固定 60s 窗口，0 = 不限），计数存在共享状态里，所有 worker 共用
+memorize_rate_limit = int(os.getenv("MEMU_MEMORIZE_RATE_LIMIT", "0"))
+
+
+async def _check_rate_limit(user_id: str | None) -> None:
+    if memorize_rate_limit <= 0:
+        return
+    window = int(time.time() // 60)
+    count = await shared.incr(f"memu:rl:memorize:{user_id or UNSCOPED}:{window}", ttl=60)
+    if count > memorize_rate_limit:
+        raise HTTPException(status_code=429, detail=f"memorize rate limit exceeded for user '{user_id}'")
+
+
+async def _user_generation(user_id: str | None) -> int:
+    """每用户数据版本号；memorize 成功后自增，用于让各 worker 的用户级缓存失效"""
+    return int(await shared.get(f"memu:gen:{user_id or UNSCOPED}") or 0)
+
+
+async def _bump_generation(user_id: str | None) -> None:
+    # 不带范围的检索覆盖所有用户的记忆，任一用户变化都要让它失效
+    if user_id:
+        await shared.incr(f"memu:gen:{user_id}")
+    await shared.incr(f"memu:gen:{UNSCOPED}")
+
+
+def _payload_user_id(payload: Dict[str, Any]) -> str | None:
+    """从请求体提取 user_id：memorize 用 user.user_id，retrieve.py 用 where.user_id；都没有时返回 None（不限用户）"""
+    for key in ("user", "where"):
+        scope = payload.get(key)
+        if isinstance(scope, dict) and scope.get("user_id"):
+            return str(scope["user_id"])
+    return None
+
+
+# ===== Ollama 预热 & 保活 =====
+# 服务先启动，模型在后台并发预热；/healthz 只表示进程存活，/readyz 表示 embedding 模型已就绪
+# Ollama 原生 API（/api/*）支持 keep_alive 参数，OpenAI 兼容接口（/v1）不支持
+ollama_native_url = os.getenv("OLLAMA_NATIVE_URL", ollama_base_url.rstrip("/").removesuffix("/v1"))
+ollama_keep_alive = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+# 保活间隔需小于 keep_alive，否则模型仍可能在两次 ping 之间被卸载
+keepalive_interval = float(os.getenv("OLLAMA_KEEPALIVE_INTERVAL", "300"))
+warmup_timeout = float(os.getenv("OLLAMA_WARMUP_TIMEOUT", "120"))
+
+model_status: Dict[str, Dict[str, Any]] = {
+    "embed": {"model": embed_model, "ready": False, "error": None, "last_ping": None},
+    "chat": {"model": ollama_chat_model, "ready": False, "error": None, "last_ping": None},
+}
+_background_tasks: set = set()
+
+
+def _spawn(coro) -> asyncio.Task:
+    """创建后台任务并持有引用（防止被 GC），shutdown 时统一取消"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+async def _ping_model(client: httpx.AsyncClient, kind: str) -> None:
+    """加载模型到内存并刷新 keep_alive（embed 走 /api/embed，chat 走不带 prompt 的 /api/generate）"""
+    status = model_status[kind]
+    if kind == "embed":
+        path, body = "/api/embed", {"model": embed_model, "input": "warmup"}
+    else:
+        path, body = "/api/generate", {"model": ollama_chat_model}
+    body["keep_alive"] = ollama_keep_alive
+    try:
+        r = await client.post(f"{ollama_native_url}{path}", json=body)
+        r.raise_for_status()
+        status.update(ready=True, error=None, last_ping=time.time())
+    except Exception as exc:
+        status.update(ready=False, error=str(exc) or type(exc).__name__)
+
+
+async def _wait_for_ollama(client: httpx.AsyncClient) -> None:
+    """指数退避等待 Ollama 可用（最长 10s 间隔，不设上限，直到进程退出）"""
+    delay = 1.0
+    while True:
+        try:
+            r = await client.get(f"{ollama_native_url}/api/version", timeout=5.0)
+            if r.status_code == 200:
+                print(f"✅ Ollama 可用: {ollama_native_url}")
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 10.0)
+
+
+async def _ping_all(client: httpx.AsyncClient) -> None:
+    """只由持有锁的 worker 执行 ping，结果写入共享状态供所有 worker 的 /readyz 使用"""
+    if not await shared.try_lock("memu:lock:keepalive", ttl=keepalive_interval * 0.9):
+        return
+    await asyncio.gather(_ping_model(client, "embed"), _ping_model(client, "chat"))
+    await shared.set("memu:models", json.dumps(model_status), ttl=keepalive_interval * 3)
+
+
+async def _ping_cycle(client: httpx.AsyncClient) -> None:
+    """单次保活；共享状态（Redis）短暂不可用时只记录错误，下个周期继续，不能让保活任务退出"""
+    try:
+        await _ping_all(client)
+    except Exception:
+        traceback.print_exc()
+
+
+async def _warmup_and_keepalive() -> None:
+    timeout = httpx.Timeout(connect=10.0, read=warmup_timeout, write=30.0, pool=30.0)
+    async with httpx.AsyncClient(timeout=timeout) as client:
+        await _wait_for_ollama(client)
+        started = time.time()
+        await _ping_cycle(client)
+        for kind, status in model_status.items():
+            if status["ready"]:
+                print(f"🔥 {kind} 模型预热完成: {status['model']} ({time.time() - started:.1f}s)")
+            elif status["error"]:
+                print(f"⚠️  {kind} 模型预热失败: {status['model']}: {status['error']}")
+        while True:
+            await asyncio.sleep(keepalive_interval)
+            await _ping_cycle(client)
+
+
+@app.on_event("startup")
+async def _start_background_tasks():
+    _spawn(_warmup_and_keepalive())
+    _spawn(_check_memu_compat())
+    if consolidate_interval > 0:
+        _spawn(_consolidate_loop())
+
+
+@app.on_event("shutdown")
+async def _stop_background_tasks():
+    tasks = list(_background_tasks)
+    for task in tasks:
+        task.cancel()
+    # 整合任务可能正处于数据库事务中，最多等待 5s 后继续退出流程
+    if tasks:
+        await asyncio.wait(tasks, timeout=5)
+
+
+# ===== pgvector 直连检索 =====
+# mode=vector/hybrid 时 /retrieve 绕过 memU 的检索流程，直接在 Postgres 上做按用户过滤的 HNSW 检索
+# 索引由 config/memu-vector-tuning.sql 建立，MEMU_VECTOR_PRECISION 必须与建索引时的 precision 一致
+database_url = os.getenv("DATABASE_URL", "").replace("postgresql+psycopg://", "postgresql://")
+items_table = os.getenv("MEMU_ITEMS_TABLE", "memory_items")
+embed_dims = int(os.getenv("MEMU_EMBED_DIMS", "768"))
+vector_precision = os.getenv("MEMU_VECTOR_PRECISION", "halfvec")  # halfvec | vector | bit
+hnsw_ef_search = int(os.getenv("MEMU_HNSW_EF_SEARCH", "40"))
+# pgvector >= 0.8：过滤条件导致 HNSW 候选不足时继续扫描，留空则关闭
+hnsw_iterative_scan = os.getenv("MEMU_HNSW_ITERATIVE_SCAN", "relaxed_order")
+# bit 量化时先按汉明距离取 limit * rerank 个候选，再按原始向量重排
+bit_rerank_factor = int(os.getenv("MEMU_BIT_RERANK_FACTOR", "4"))
+default_retrieve_mode = os.getenv("MEMU_RETRIEVE_MODE", "memu")  # memu | vector | hybrid
+
+_pg_pool = None
+_embed_client = httpx.AsyncClient(timeout=httpx.Timeout(connect=10.0, read=60.0, write=30.0, pool=30.0))
+
+
+async def _pg():
+    global _pg_pool
+    if _pg_pool is None:
+        from pgvector.psycopg import register_vector_async
+        from psycopg.rows import dict_row
+        from psycopg_pool import AsyncConnectionPool
+
+        _pg_pool = AsyncConnectionPool(
+            database_url,
+            min_size=1,
+            max_size=int(os.getenv("MEMU_PG_POOL_SIZE", "5")),
+            kwargs={"row_factory": dict_row},
+            configure=register_vector_async,
+            open=False,
+        )
+        await _pg_pool.open()
+    return _pg_pool
+
+
+async def _embed(texts: list) -> list:
+    """通过 Ollama OpenAI 兼容接口生成 embedding"""
+    async with _span("embed", model=embed_model, count=len(texts)):
+        r = await _embed_client.post(
+            f"{ollama_base_url}/embeddings",
+            json={"model": embed_model, "input": texts},
+            headers=_trace_headers(),
+        )
+        r.raise_for_status()
+    return [d["embedding"] for d in sorted(r.json()["data"], key=lambda d: d["index"])]
+
+
+def _vector_literal(vec) -> str:
+    return "[" + ",".join(f"{float(x):.7g}" for x in vec) + "]"
+
+
+def _search_sql(scoped: bool = True) -> str:
+    cols = "id, summary, memory_type, created_at"
+    where = "WHERE user_id = %(user_id)s" if scoped else "WHERE embedding IS NOT NULL"
+    if vector_precision == "bit":
+        return f"""
+            SELECT {cols}, 1 - distance AS score FROM (
+                SELECT {cols}, embedding <=> %(q)s::vector AS distance
+                FROM {items_table} {where}
+                ORDER BY binary_quantize(embedding)::bit({embed_dims}) <~> binary_quantize(%(q)s::vector)
+                LIMIT %(candidates)s
+            ) c ORDER BY distance LIMIT %(limit)s
+        """
+    expr = "embedding" if vector_precision == "vector" else f"embedding::halfvec({embed_dims})"
+    cast = "vector" if vector_precision == "vector" else f"halfvec({embed_dims})"
+    return f"""
+        SELECT {cols}, 1 - ({expr} <=> %(q)s::{cast}) AS score
+        FROM {items_table} {where}
+        ORDER BY {expr} <=> %(q)s::{cast}
+        LIMIT %(limit)s
+    """
+
+
+async def _pg_search(user_id: str | None, query_vec, limit: int, ef_search: int | None = None) -> list:
+    """按用户过滤的 ANN 检索（user_id 为 None 时不过滤），ef_search 仅作用于本次事务"""
+    pool = await _pg()
+    async with (
+        _span("store.vector_search", ef_search=ef_search or hnsw_ef_search),
+        pool.connection() as conn,
+        conn.transaction(),
+    ):
+        await conn.execute("SELECT set_config('hnsw.ef_search', %s, true)", (str(ef_search or hnsw_ef_search),))
+        if hnsw_iterative_scan:
+            await conn.execute("SELECT set_config('hnsw.iterative_scan', %s, true)", (hnsw_iterative_scan,))
+        cur = await conn.execute(
+            _search_sql(scoped=user_id is not None),
+            {
+                "q": _vector_literal(query_vec),
+                "user_id": user_id,
+                "limit": limit,
+                "candidates": limit * bit_rerank_factor,
+            },
+        )
+        rows = await cur.fetchall()
+    return [dict(_item_from_row(r), score=float(r["score"])) for r in rows]
+
+
+def _item_from_row(r: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": str(r["id"]),
+        "summary": r["summary"],
+        "memory_type": r["memory_type"],
+        "created_at": r["created_at"].isoformat() if r["created_at"] else None,
+    }
+
+
+@app.on_event("shutdown")
+async def _close_clients():
+    await _embed_client.aclose()
+    if _pg_pool is not None:
+        await _pg_pool.close()
+
+
+# ===== 热用户内存向量层 =====
+# 最近活跃用户的全部记忆向量以连续矩阵（L2 归一化）常驻内存，检索是一次矩阵-向量乘；
+# 冷用户回落到 pgvector，并在后台加载。按总字节数做 LRU 淘汰。
+# 失效：memorize 成功后自增共享版本号，各 worker 查询时发现版本不一致即丢弃该用户矩阵。
+hot_tier_bytes = int(float(os.getenv("MEMU_HOT_TIER_MB", "256")) * 1024 * 1024)
+hot_tier_dtype = np.dtype(os.getenv("MEMU_HOT_TIER_DTYPE", "float16"))  # float16 | float32
+# hybrid 模式：关键词 n-gram 长度、各路候选数倍数、RRF 常数
+ngram_n = int(os.getenv("MEMU_NGRAM_N", "2"))
+hybrid_candidates = int(os.getenv("MEMU_HYBRID_CANDIDATES", "4"))
+rrf_k = int(os.getenv("MEMU_RRF_K", "60"))
+
+
+class NgramIndex:
+    """每用户 BM25 倒排索引：中日韩字符取 n-gram（无需分词器），拉丁字母/数字按整词（SKU、英文名）"""
+
+    K1 = 1.2
+    B = 0.75
+    _CJK = r"\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af\uf900-\ufaff"
+    _TOKEN_RE = re.compile(rf"[0-9a-z]+(?:[-_.][0-9a-z]+)*|[{_CJK}]+")
+    _CJK_RE = re.compile(rf"[{_CJK}]")
+
+    def __init__(self, texts: list, n: int):
+        self.n = n
+        postings: Dict[str, Dict[int, int]] = {}
+        lengths = np.zeros(len(texts), dtype=np.float32)
+        for doc, text in enumerate(texts):
+            terms = self.tokenize(text or "")
+            lengths[doc] = len(terms)
+            for term in terms:
+                tf = postings.setdefault(term, {})
+                tf[doc] = tf.get(doc, 0) + 1
+        self.size = len(texts)
+        self.avgdl = float(lengths.mean()) if len(texts) else 0.0
+        self.lengths = lengths
+        self.postings = {
+            term: (np.fromiter(tf.keys(), dtype=np.int32), np.fromiter(tf.values(), dtype=np.float32))
+            for term, tf in postings.items()
+        }
+        self.nbytes = lengths.nbytes + sum(d.nbytes + f.nbytes for d, f in self.postings.values())
+
+    def tokenize(self, text: str) -> list:
+        terms = []
+        for run in self._TOKEN_RE.findall(unicodedata.normalize("NFKC", text).lower()):
+            if not self._CJK_RE.match(run):
+                terms.append(run)
+            elif len(run) <= self.n:
+                terms.append(run)
+            else:
+                terms.extend(run[i : i + self.n] for i in range(len(run) - self.n + 1))
+        return terms
+
+    def search(self, query: str, limit: int) -> list:
+        """返回 [(doc, bm25)]，按得分降序"""
+        if not self.size:
+            return []
+        scores = np.zeros(self.size, dtype=np.float32)
+        norm = self.K1 * (1 - self.B + self.B * self.lengths / (self.avgdl or 1.0))
+        for term in set(self.tokenize(query)):
+            hit = self.postings.get(term)
+            if hit is None:
+                continue
+            docs, tf = hit
+            idf = np.log(1 + (self.size - len(docs) + 0.5) / (len(docs) + 0.5))
+            scores[docs] += idf * tf * (self.K1 + 1) / (tf + norm[docs])
+        matched = np.flatnonzero(scores)
+        if not len(matched):
+            return []
+        k = min(limit, len(matched))
+        top = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        top = top[np.argsort(-scores[top])]
+        return [(int(i), float(scores[i])) for i in top]
+
+
+class HotVectorTier:
+    # float16 矩阵分块转 float32 后再乘，走 BLAS 且临时内存有上限
+    BLOCK_ROWS = 8192
+
+    def __init__(self, max_bytes: int, dtype: np.dtype):
+        self.max_bytes = max_bytes
+        self.dtype = dtype
+        self._users: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._loading: set = set()
+        # 超出 max_bytes 的用户 -> 当时的版本号；同一版本内不再重复读库
+        self._oversized: Dict[str, int] = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _drop(self, user_id: str) -> None:
+        entry = self._users.pop(user_id, None)
+        if entry is not None:
+            self.nbytes -= entry["nbytes"]
+
+    def invalidate(self, user_id: str) -> None:
+        self._drop(user_id)
+
+    def oversized(self, user_id: str, generation: int) -> bool:
+        return self._oversized.get(user_id) == generation
+
+    def get(self, user_id: str, generation: int) -> Dict[str, Any] | None:
+        """返回该用户的矩阵/索引；未加载或版本过期返回 None"""
+        entry = self._users.get(user_id)
+        if entry is None or entry["generation"] != generation:
+            self._drop(user_id)
+            self.misses += 1
+            return None
+        self._users.move_to_end(user_id)
+        self.hits += 1
+        return entry
+
+    def _scores(self, matrix: np.ndarray, q: np.ndarray) -> np.ndarray:
+        if matrix.dtype == np.float32:
+            return matrix @ q
+        out = np.empty(len(matrix), dtype=np.float32)
+        for start in range(0, len(matrix), self.BLOCK_ROWS):
+            block = matrix[start : start + self.BLOCK_ROWS]
+            out[start : start + len(block)] = block.astype(np.float32) @ q
+        return out
+
+    def vector_search(self, entry: Dict[str, Any], query_vec, limit: int) -> list:
+        """返回 [(doc, cosine)]，按相似度降序"""
+        matrix = entry["matrix"]
+        if not len(matrix):
+            return []
+        q = np.asarray(query_vec, dtype=np.float32)
+        q /= np.linalg.norm(q) or 1.0
+        scores = self._scores(matrix, q)
+        k = min(limit, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(i), float(scores[i])) for i in top]
+
+    def _build(self, rows: list) -> Dict[str, Any]:
+        matrix = np.empty((len(rows), embed_dims), dtype=np.float32)
+        for i, r in enumerate(rows):
+            matrix[i] = r["embedding"]
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix /= np.where(norms == 0, 1.0, norms)
+        matrix = np.ascontiguousarray(matrix, dtype=self.dtype)
+        items = [_item_from_row(r) for r in rows]
+        keywords = NgramIndex([item["summary"] for item in items], ngram_n)
+        # 每行的 dict 与其中的字符串（id、summary、类型、时间）也常驻内存，摘要较长时不小于矩阵本身
+        items_bytes = sys.getsizeof(items) + sum(
+            sys.getsizeof(item) + sum(sys.getsizeof(v) for v in item.values()) for item in items
+        )
+        return {
+            "matrix": matrix,
+            "items": items,
+            "keywords": keywords,
+            "nbytes": matrix.nbytes + keywords.nbytes + items_bytes,
+        }
+
+    async def load(self, user_id: str, generation: int) -> None:
+        """从 Postgres 读取该用户全部向量；generation 需在读库之前取得，避免覆盖并发 memorize 的失效"""
+        if user_id in self._loading or self.oversized(user_id, generation):
+            return
+        self._loading.add(user_id)
+        try:
+            pool = await _pg()
+            async with pool.connection() as conn:
+                # 仅矩阵就放不下时不必读取向量
+                cur = await conn.execute(
+                    f"SELECT count(*) AS n FROM {items_table} WHERE user_id = %s AND embedding IS NOT NULL",
+                    (user_id,),
+                )
+                if (await cur.fetchone())["n"] * embed_dims * self.dtype.itemsize > self.max_bytes:
+                    self._oversized[user_id] = generation
+                    return
+                cur = await conn.execute(
+                    f"SELECT id, summary, memory_type, created_at, embedding::vector AS embedding "
+                    f"FROM {items_table} WHERE user_id = %s AND embedding IS NOT NULL",
+                    (user_id,),
+                )
+                rows = await cur.fetchall()
+            # 矩阵归一化与倒排索引构建是 CPU 密集操作，放到线程里避免阻塞事件循环
+            entry = await asyncio.to_thread(self._build, rows)
+            if entry["nbytes"] > self.max_bytes:
+                self._oversized[user_id] = generation
+                return
+            self._oversized.pop(user_id, None)
+            self._drop(user_id)
+            self._users[user_id] = dict(entry, generation=generation)
+            self.nbytes += entry["nbytes"]
+            while self.nbytes > self.max_bytes:
+                self._drop(next(iter(self._users)))
+                self.evictions += 1
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self._loading.discard(user_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "users": len(self._users),
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "dtype": str(self.dtype),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "oversized_users": len(self._oversized),
+        }
+
+
+hot_tier = HotVectorTier(hot_tier_bytes, hot_tier_dtype)
+
+
+async def _vector_search(
+    user_id: str | None, query_vec, limit: int, ef_search: int | None = None, query: str | None = None
+) -> tuple:
+    """热用户走内存矩阵，冷用户走 pgvector 并触发后台加载；传入 query 时做 hybrid（BM25 + 向量，RRF 融合）
+
+    返回 (items, mode_used)。关键词索引只建在热用户层上：热用户层关闭、不限用户、用户超出内存上限
+    或尚在加载时，hybrid 只能返回向量结果，mode_used 为 "vector"。
+    """
+    if hot_tier.max_bytes <= 0 or user_id is None:
+        return await _pg_search(user_id, query_vec, limit, ef_search), "vector"
+    generation = await _user_generation(user_id)
+    entry = hot_tier.get(user_id, generation)
+    if entry is None:
+        if not hot_tier.oversized(user_id, generation):
+            _spawn(hot_tier.load(user_id, generation))
+        return await _pg_search(user_id, query_vec, limit, ef_search), "vector"
+    async with _span("hot_tier.search", hybrid=query is not None, items=len(entry["items"])):
+        if query is None:
+            items = [dict(entry["items"][i], score=s) for i, s in hot_tier.vector_search(entry, query_vec, limit)]
+            return items, "vector"
+        items = _rrf_fuse(
+            entry["items"],
+            {
+                "vector": hot_tier.vector_search(entry, query_vec, limit * hybrid_candidates),
+                "keyword": entry["keywords"].search(query, limit * hybrid_candidates),
+            },
+            limit,
+        )
+        return items, "hybrid"
+
+
+def _rrf_fuse(items: list, rankings: Dict[str, list], limit: int) -> list:
+    """Reciprocal Rank Fusion：score = Σ 1 / (k + rank)，各路排名记录在 ranks 字段中"""
+    fused: Dict[int, Dict[str, Any]] = {}
+    for name, ranking in rankings.items():
+        for rank, (doc, _) in enumerate(ranking, 1):
+            hit = fused.setdefault(doc, {"score": 0.0, "ranks": {}})
+            hit["score"] += 1.0 / (rrf_k + rank)
+            hit["ranks"][name] = rank
+    top = sorted(fused.items(), key=lambda kv: kv[1]["score"], reverse=True)[:limit]
+    return [dict(items[doc], **hit) for doc, hit in top]
+
+
+# ===== 检索结果缓存 =====
+# key = (用户, 用户数据版本号, 检索参数, 归一化查询)；memorize 自增该用户版本号后旧条目自然不再命中，
+# 其他用户的缓存不受影响。缓存的是序列化后的响应体，命中时不再 embedding / 检索 / 序列化。
+retrieve_cache_ttl = float(os.getenv("MEMU_RETRIEVE_CACHE_TTL", "600"))  # 0 = 关闭
+_RC_PREFIX = "memu:rc:"
+
+
+def _normalize_query(query: str) -> str:
+    text = unicodedata.normalize("NFKC", query).casefold()
+    return " ".join(text.split()).rstrip("?？。.!！ ")
+
+
+def _retrieve_cache_key(user_id: str | None, generation: int, payload: Dict[str, Any], mode: str) -> str:
+    params = [mode, payload.get("limit", 10), payload.get("ef_search"), _normalize_query(payload["query"])]
+    digest = hashlib.sha1(json.dumps(params, ensure_ascii=False).encode("utf-8")).hexdigest()
+    return f"{_RC_PREFIX}{user_id or UNSCOPED}:{generation}:{digest}"
+
+
+async def _retrieve_cache_stats() -> Dict[str, Any]:
+    hits = int(await shared.get("memu:stats:rc:hits") or 0)
+    misses = int(await shared.get("memu:stats:rc:misses") or 0)
+    return {
+        "ttl": retrieve_cache_ttl,
+        "hits": hits,
+        "misses": misses,
+        "hit_ratio": round(hits / (hits + misses), 4) if hits + misses else None,
+        **await shared.footprint(_RC_PREFIX),
+    }
+
+
+# ===== 用户画像 =====
+# 每用户一行物化画像（主要分类 + 关键事实），memorize / 整合后在后台按该用户刷新；
+# GET /profile/{user_id} 只做主键查询，不调用 embedding / LLM。
+# 刷新按用户重新聚合（走 user_id 索引，只读该用户的行），行内记录聚合时的用户版本号，
+# 只有版本号更新的结果才能覆盖，避免较早开始的刷新晚提交时把新画像覆盖掉。
+profiles_table = os.getenv("MEMU_PROFILES_TABLE", "memu_user_profiles")
+categories_table = os.getenv("MEMU_CATEGORIES_TABLE", "memory_categories")
+profile_max_facts = int(os.getenv("MEMU_PROFILE_FACTS", "20"))
+profile_max_categories = int(os.getenv("MEMU_PROFILE_CATEGORIES", "10"))
+_profile_table_ready = False
+
+
+async def _ensure_profile_table(conn) -> None:
+    global _profile_table_ready
+    if not _profile_table_ready:
+        await conn.execute(
+            f"""CREATE TABLE IF NOT EXISTS {profiles_table} (
+                    user_id TEXT PRIMARY KEY,
+                    profile JSONB NOT NULL,
+                    generation BIGINT NOT NULL DEFAULT 0,
+                    updated_at TIMESTAMPTZ NOT NULL DEFAULT now())"""
+        )
+        await conn.execute(
+            f"ALTER TABLE {profiles_table} ADD COLUMN IF NOT EXISTS generation BIGINT NOT NULL DEFAULT 0"
+        )
+        _profile_table_ready = True
+
+
+async def _refresh_profile(user_id: str) -> Dict[str, Any]:
+    """只聚合该用户的数据（走 user_id 索引），结果写回画像表；没有任何记忆的用户不写入"""
+    # 版本号必须在读数据之前取得：聚合期间发生的变化会带来更大的版本号和又一次刷新
+    generation = await _user_generation(user_id)
+    pool = await _pg()
+    async with pool.connection() as conn:
+        await _ensure_profile_table(conn)
+        cur = await conn.execute(f"SELECT count(*) AS n FROM {items_table} WHERE user_id = %s", (user_id,))
+        count = (await cur.fetchone())["n"]
+        categories = []
+        cur = await conn.execute("SELECT to_regclass(%s) IS NOT NULL AS ok", (category_items_table,))
+        if (await cur.fetchone())["ok"]:
+            cur = await conn.execute(
+                f"""SELECT c.name, count(*) AS count
+                    FROM {category_items_table} r
+                    JOIN {categories_table} c ON c.id = r.category_id
+                    JOIN {items_table} i ON i.id = r.item_id
+                    WHERE i.user_id = %s
+                    GROUP BY c.name ORDER BY count DESC, c.name LIMIT %s""",
+                (user_id, profile_max_categories),
+            )
+            categories = [{"name": r["name"], "count": r["count"]} for r in await cur.fetchall()]
+        # 画像类记忆优先，其次按时间倒序
+        cur = await conn.execute(
+            f"""SELECT id, summary, memory_type, created_at FROM {items_table}
+                WHERE user_id = %s
+                ORDER BY (memory_type = 'profile') DESC, created_at DESC LIMIT %s""",
+            (user_id, profile_max_facts),
+        )
+        facts = [_item_from_row(r) for r in await cur.fetchall()]
+        profile = {
+            "user_id": user_id,
+            "memory_count": count,
+            "categories": categories,
+            "facts": facts,
+            "updated_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        }
+        if count:
+            await conn.execute(
+                f"""INSERT INTO {profiles_table} (user_id, profile, generation, updated_at)
+                    VALUES (%s, %s::jsonb, %s, now())
+                    ON CONFLICT (user_id) DO UPDATE
+                    SET profile = EXCLUDED.profile, generation = EXCLUDED.generation, updated_at = now()
+                    WHERE {profiles_table}.generation < EXCLUDED.generation""",
+                (user_id, json.dumps(profile, ensure_ascii=False), generation),
+            )
+    return profile
+
+
+_profile_refreshing: Dict[str, bool] = {}  # user_id -> 刷新期间是否又有变化
+
+
+async def _refresh_profile_quietly(user_id: str) -> None:
+    """同一 worker 内按用户合并刷新：进行中时只做标记，结束后再刷新一次"""
+    if user_id in _profile_refreshing:
+        _profile_refreshing[user_id] = True
+        return
+    _profile_refreshing[user_id] = False
+    try:
+        while True:
+            await _refresh_profile(user_id)
+            if not _profile_refreshing[user_id]:
+                break
+            _profile_refreshing[user_id] = False
+    except Exception:
+        traceback.print_exc()
+    finally:
+        _profile_refreshing.pop(user_id, None)
+
+
+async def _on_user_changed(user_id: str | None) -> None:
+    """用户记忆发生变化：使各 worker 的缓存失效，并在后台刷新画像"""
+    await _bump_generation(user_id)
+    if user_id:
+        hot_tier.invalidate(user_id)
+        _spawn(_refresh_profile_quietly(user_id))
+
+
+# ===== 记忆整合去重 =====
+# 定时（或手动 POST /consolidate）按用户把 embedding 余弦相似度 >= 阈值的同类型记忆聚为一簇，
+# 用 summarize（Zhipu）合并文本后保留最早的一条、删除其余行；只有一个 worker 持锁执行。
+consolidate_interval = float(os.getenv("MEMU_CONSOLIDATE_INTERVAL", "21600"))  # 秒，0 = 不定时执行
+dedup_threshold = float(os.getenv("MEMU_DEDUP_THRESHOLD", "0.92"))
+# 有记忆被删除时 REINDEX INDEX CONCURRENTLY 记忆表上的 HNSW 索引，索引才会真正变小（默认 0 = 只 VACUUM）
+consolidate_reindex = os.getenv("MEMU_CONSOLIDATE_REINDEX", "0") == "1"
+CONSOLIDATE_LOCK_TTL = 300
+category_items_table = os.getenv("MEMU_CATEGORY_ITEMS_TABLE", "category_items")
+MERGE_PROMPT = (
+    "以下是同一用户的若干条相近记忆（每行一条）。请合并为一条简洁、完整的记忆，"
+    "保留所有不重复的事实，不要添加新信息，只输出合并后的内容。"
+)
+
+
+def _dedup_clusters(matrix: np.ndarray, types: list, threshold: float) -> list:
+    """贪心聚类：按顺序取未归类的条目为中心，吸收相似度 >= threshold 且类型相同的条目；只返回成员数 > 1 的簇"""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix = matrix / np.where(norms == 0, 1.0, norms)
+    assigned = np.zeros(len(matrix), dtype=bool)
+    types = np.asarray(types, dtype=object)
+    clusters = []
+    for i in range(len(matrix)):
+        if assigned[i]:
+            continue
+        # 整个矩阵乘一次再按 ~assigned 过滤，避免每个中心都复制一份候选子矩阵
+        sims = matrix @ matrix[i]
+        members = np.flatnonzero(~assigned & (sims >= threshold) & (types == types[i]))
+        assigned[members] = True
+        if len(members) > 1:
+            clusters.append([int(m) for m in members])
+    return clusters
+
+
+async def _table_bytes(conn) -> Dict[str, int]:
+    cur = await conn.execute(
+        "SELECT pg_relation_size(%s::regclass) AS table_bytes, pg_indexes_size(%s::regclass) AS index_bytes",
+        (items_table, items_table),
+    )
+    return dict(await cur.fetchone())
+
+
+async def _consolidate_user(user_id: str) -> Dict[str, Any]:
+    pool = await _pg()
+    async with pool.connection() as conn:
+        cur = await conn.execute(
+            f"SELECT id, summary, memory_type, embedding::vector AS embedding "
+            f"FROM {items_table} WHERE user_id = %s AND embedding IS NOT NULL ORDER BY created_at, id",
+            (user_id,),
+        )
+        rows = await cur.fetchall()
+    if len(rows) < 2:
+        return {"user_id": user_id, "items_before": len(rows), "items_after": len(rows), "clusters": 0}
+
+    matrix = np.stack([np.asarray(r["embedding"], dtype=np.float32) for r in rows])
+    clusters = await asyncio.to_thread(
+        _dedup_clusters, matrix, [r["memory_type"] for r in rows], dedup_threshold
+    )
+
+    merges = []
+    for members in clusters:
+        texts = list(dict.fromkeys((rows[i]["summary"] or "").strip() for i in members))
+        # 文本完全相同的簇无需调用 LLM
+        merged = texts[0] if len(texts) == 1 else (
+            await service.openai.summarize("\n".join(texts), system_prompt=MERGE_PROMPT)
+        ).strip() or texts[0]
+        merges.append((rows[members[0]]["id"], merged, [rows[i]["id"] for i in members[1:]]))
+    if not merges:
+        return {"user_id": user_id, "items_before": len(rows), "items_after": len(rows), "clusters": 0}
+
+    embeddings = await _embed([merged for _, merged, _ in merges])
+    removed = 0
+    embedding_bytes = 0
+    async with pool.connection() as conn, conn.transaction():
+        cur = await conn.execute("SELECT to_regclass(%s) IS NOT NULL AS ok", (category_items_table,))
+        has_relations = (await cur.fetchone())["ok"]
+        for (keep_id, merged, drop_ids), vec in zip(merges, embeddings):
+            await conn.execute(
+                f"UPDATE {items_table} SET summary = %s, embedding = %s::vector WHERE id = %s",
+                (merged, _vector_literal(vec), keep_id),
+            )
+            cur = await conn.execute(
+                f"SELECT coalesce(sum(pg_column_size(embedding)), 0) AS n FROM {items_table} WHERE id = ANY(%s)",
+                (drop_ids,),
+            )
+            embedding_bytes += (await cur.fetchone())["n"]
+            if has_relations:
+                # 被删条目的分类关系转移到保留条目（已存在的关系直接删除）
+                await conn.execute(
+                    f"""UPDATE {category_items_table} r SET item_id = %(keep)s
+                        WHERE r.item_id = ANY(%(drop)s) AND NOT EXISTS (
+                            SELECT 1 FROM {category_items_table} k
+                            WHERE k.item_id = %(keep)s AND k.category_id = r.category_id)""",
+                    {"keep": keep_id, "drop": drop_ids},
+                )
+                await conn.execute(
+                    f"DELETE FROM {category_items_table} WHERE item_id = ANY(%s)", (drop_ids,)
+                )
+            cur = await conn.execute(f"DELETE FROM {items_table} WHERE id = ANY(%s)", (drop_ids,))
+            removed += cur.rowcount
+
+    await _on_user_changed(user_id)
+    return {
+        "user_id": user_id,
+        "items_before": len(rows),
+        "items_after": len(rows) - removed,
+        "clusters": len(merges),
+        "embedding_bytes_removed": int(embedding_bytes),
+    }
+
+
+async def _consolidate(user_ids: list | None = None) -> Dict[str, Any]:
+    """整合指定用户（默认全部），报告行数与表/索引体积变化"""
+    started = time.time()
+    pool = await _pg()
+    async with pool.connection() as conn:
+        before = await _table_bytes(conn)
+        if user_ids is None:
+            cur = await conn.execute(f"SELECT DISTINCT user_id FROM {items_table} WHERE user_id IS NOT NULL")
+            user_ids = [r["user_id"] for r in await cur.fetchall()]
+    users = []
+    for user_id in user_ids:
+        try:
+            users.append(await _consolidate_user(user_id))
+        except Exception as exc:
+            traceback.print_exc()
+            users.append({"user_id": user_id, "error": str(exc)})
+    removed = sum(u.get("items_before", 0) - u.get("items_after", 0) for u in users)
+    maintenance = await _consolidate_maintenance(pool) if removed else {}
+    async with pool.connection() as conn:
+        after = await _table_bytes(conn)
+    report = {
+        "finished_at": time.time(),
+        "duration": round(time.time() - started, 2),
+        "items_removed": removed,
+        # 被删除行 embedding 列的实际存储字节数（pg_column_size）
+        "embedding_bytes_removed": sum(u.get("embedding_bytes_removed", 0) for u in users),
+        "table_bytes": {"before": before["table_bytes"], "after": after["table_bytes"]},
+        "index_bytes": {"before": before["index_bytes"], "after": after["index_bytes"]},
+        "maintenance": maintenance,
+        "users": users,
+    }
+    await shared.set("memu:consolidate:last", json.dumps(report, ensure_ascii=False))
+    print(f"🧹 记忆整合完成: {len(users)} 个用户，删除 {removed} 条重复记忆（{report['duration']}s）")
+    return report
+
+
+async def _consolidate_maintenance(pool) -> Dict[str, Any]:
+    """删除后的 VACUUM / 重建 HNSW 索引；尽力而为，失败只记入报告（各用户的删除已经提交）"""
+    result: Dict[str, Any] = {"vacuumed": False, "reindexed": []}
+    async with pool.connection() as conn:
+        # VACUUM / REINDEX CONCURRENTLY 不能在事务中执行
+        await conn.set_autocommit(True)
+        try:
+            # VACUUM 让死元组空间可被复用，但不会把表文件还给操作系统
+            await conn.execute(f"VACUUM (ANALYZE) {items_table}")
+            result["vacuumed"] = True
+            if consolidate_reindex:
+                # 只重建 memu-vector-tuning.sql 建立的 HNSW 索引；CONCURRENTLY 不阻塞读写
+                cur = await conn.execute(
+                    """SELECT indexrelid::regclass::text AS name FROM pg_index
+                       WHERE indrelid = %s::regclass AND indexrelid::regclass::text LIKE %s""",
+                    (items_table, "%\\_embedding\\_hnsw"),
+                )
+                for r in await cur.fetchall():
+                    await conn.execute(f"REINDEX INDEX CONCURRENTLY {r['name']}")
+                    result["reindexed"].append(r["name"])
+        except Exception as exc:
+            traceback.print_exc()
+            result["error"] = str(exc)
+            # 失败的 REINDEX CONCURRENTLY 会留下无效的 *_ccnew 索引，清理掉
+            try:
+                cur = await conn.execute(
+                    """SELECT indexrelid::regclass::text AS name FROM pg_index
+                       WHERE indrelid = %s::regclass AND NOT indisvalid
+                         AND indexrelid::regclass::text LIKE %s""",
+                    (items_table, "%\\_ccnew%"),
+                )
+                for r in await cur.fetchall():
+                    await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {r['name']}")
+            except Exception:
+                traceback.print_exc()
+        finally:
+            await conn.set_autocommit(False)
+    return result
+
+
+async def _hold_lock(key: str, owner: str, ttl: float) -> None:
+    """持锁期间每 ttl/3 续期一次，避免长时间运行时锁过期被其他 worker 取得"""
+    while True:
+        await asyncio.sleep(ttl / 3)
+        if not await shared.extend_lock(key, owner, ttl):
+            print(f"⚠️  锁 {key} 已丢失")
+            return
+
+
+async def _run_consolidation(user_ids: list | None = None) -> Dict[str, Any] | None:
+    """持有运行锁执行整合；已有 worker 在执行时返回 None"""
+    owner = f"{os.getpid()}:{uuid.uuid4().hex}"
+    if not await shared.try_lock("memu:lock:consolidate", ttl=CONSOLIDATE_LOCK_TTL, owner=owner):
+        return None
+    keeper = _spawn(_hold_lock("memu:lock:consolidate", owner, CONSOLIDATE_LOCK_TTL))
+    try:
+        return await _consolidate(user_ids)
+    finally:
+        keeper.cancel()
+        await shared.release_lock("memu:lock:consolidate", owner)
+
+
+async def _consolidate_loop() -> None:
+    while True:
+        await asyncio.sleep(consolidate_interval)
+        # 每个周期只由一个 worker 执行；Redis 短暂出错时只跳过本周期
+        try:
+            if await shared.try_lock("memu:lock:consolidate:schedule", ttl=consolidate_interval * 0.9):
+                await _run_consolidation()
+        except Exception:
+            traceback.print_exc()
+
+
+# ===== 用户记忆导出 / 导入 =====
+# 导出为 NDJSON（可 gzip）：首行 header，其后每行一条记录 {"kind", "row", "embedding"}；
+# row 是整行的 to_jsonb（不含 embedding），embedding 为小端 float32/float16 的 base64，导入时无需重新 embedding。
+# 导出用服务端游标分批读取，导入先 COPY 到临时表，再按外键顺序整表 INSERT ... SELECT。
+resources_table = os.getenv("MEMU_RESOURCES_TABLE", "resources")
+# 顺序即导入时的外键依赖顺序
+_TRANSFER_KINDS = [
+    ("resource", resources_table),
+    ("category", categories_table),
+    ("item", items_table),
+    ("relation", category_items_table),
+]
+EXPORT_VERSION = 1
+
+
+async def _transfer_tables(conn) -> list:
+    """返回 [(kind, table, scoped, has_embedding, where)]；关系表没有 user_id，按所属条目过滤"""
+    cur = await conn.execute(
+        """SELECT table_name,
+                  bool_or(column_name = 'user_id') AS scoped,
+                  bool_or(column_name = 'embedding') AS has_embedding
+           FROM information_schema.columns
+           WHERE table_schema = current_schema() AND table_name = ANY(%s)
+           GROUP BY table_name""",
+        ([table for _, table in _TRANSFER_KINDS],),
+    )
+    info = {r["table_name"]: r for r in await cur.fetchall()}
+    tables = []
+    for kind, table in _TRANSFER_KINDS:
+        if table not in info:
+            continue
+        if info[table]["scoped"]:
+            where = "t.user_id = %(user_id)s"
+        elif kind == "relation":
+            where = f"t.item_id IN (SELECT id FROM {items_table} WHERE user_id = %(user_id)s)"
+        else:
+            continue
+        tables.append((kind, table, info[table]["scoped"], info[table]["has_embedding"], where))
+    return tables
+
+
+async def _export_lines(user_id: str, dtype: np.dtype):
+    pool = await _pg()
+    async with pool.connection() as conn:
+        tables = await _transfer_tables(conn)
+        yield json.dumps(
+            {
+                "kind": "header",
+                "version": EXPORT_VERSION,
+                "user_id": user_id,
+                "dims": embed_dims,
+                "dtype": dtype.name,
+                "exported_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            }
+        ) + "\n"
+        for kind, table, _, has_embedding, where in tables:
+            embedding = "t.embedding::vector" if has_embedding else "NULL"
+            async with conn.cursor(name=f"memu_export_{kind}") as cur:
+                cur.itersize = 1000
+                await cur.execute(
+                    f"SELECT to_jsonb(t) - 'embedding' AS row, {embedding} AS embedding FROM {table} t WHERE {where}",
+                    {"user_id": user_id},
+                )
+                async for r in cur:
+                    record = {"kind": kind, "row": r["row"]}
+                    if r["embedding"] is not None:
+                        vec = np.asarray(r["embedding"], dtype=dtype.newbyteorder("<"))
+                        record["embedding"] = base64.b64encode(vec.tobytes()).decode("ascii")
+                    yield json.dumps(record, ensure_ascii=False) + "\n"
+
+
+async def _gzip_stream(lines):
+    gz = zlib.compressobj(6, zlib.DEFLATED, 31)
+    async for line in lines:
+        chunk = gz.compress(line.encode("utf-8"))
+        if chunk:
+            yield chunk
+    yield gz.flush()
+
+
+async def _ndjson_records(request: Request):
+    """流式解析请求体（按 gzip 魔数自动解压）"""
+    gunzip = None
+    buf = b""
+    async for chunk in request.stream():
+        if gunzip is None:
+            gunzip = zlib.decompressobj(47) if chunk[:2] == b"\x1f\x8b" else False
+        if gunzip:
+            chunk = gunzip.decompress(chunk)
+        buf += chunk
+        *lines, buf = buf.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+    if buf.strip():
+        yield json.loads(buf)
+
+
+async def _remap_import_ids(conn) -> None:
+    """导入到另一个用户名时给每行分配新的 UUID，并改写 *_id 外键（资源、分类、条目、关系之间的引用），
+    否则同一实例上按主键去重会把所有行当作已存在跳过"""
+    await conn.execute(
+        """CREATE TEMP TABLE _memu_idmap ON COMMIT DROP AS
+           SELECT old, gen_random_uuid()::text AS new
+           FROM (SELECT DISTINCT "row"->>'id' AS old FROM _memu_import WHERE "row" ? 'id') ids"""
+    )
+    await conn.execute("CREATE INDEX ON _memu_idmap (old)")
+    await conn.execute(
+        r"""UPDATE _memu_import SET "row" = "row" || (
+               SELECT coalesce(jsonb_object_agg(e.key, m.new), '{}'::jsonb)
+               FROM jsonb_each_text("row") e JOIN _memu_idmap m ON m.old = e.value
+               WHERE e.key = 'id' OR (e.key LIKE '%\_id' AND e.key <> 'user_id'))"""
+    )
+
+
+async def _import_user(user_id: str, request: Request) -> Dict[str, Any]:
+    started = time.time()
+    pool = await _pg()
+    counts: Dict[str, Dict[str, int]] = {}
+    async with pool.connection() as conn, conn.transaction():
+        tables = await _transfer_tables(conn)
+        await conn.execute(
+            "CREATE TEMP TABLE _memu_import (kind TEXT, row JSONB, embedding TEXT) ON COMMIT DROP"
+        )
+        header = None
+        async with conn.cursor() as cur:
+            async with cur.copy("COPY _memu_import (kind, row, embedding) FROM STDIN") as copy:
+                async for record in _ndjson_records(request):
+                    if header is None:
+                        if record.get("kind") != "header" or record.get("version") != EXPORT_VERSION:
+                            raise ValueError("Not a memU export (missing or unsupported header)")
+                        if record.get("dims") != embed_dims:
+                            raise ValueError(f"Embedding dims {record.get('dims')} != {embed_dims}")
+                        header = record
+                        dtype = np.dtype(header["dtype"]).newbyteorder("<")
+                        continue
+                    embedding = None
+                    if record.get("embedding"):
+                        embedding = _vector_literal(np.frombuffer(base64.b64decode(record["embedding"]), dtype=dtype))
+                    await copy.write_row((record["kind"], json.dumps(record["row"], ensure_ascii=False), embedding))
+        if header is None:
+            raise ValueError("Empty import body")
+
+        remapped = header["user_id"] != user_id
+        if remapped:
+            await _remap_import_ids(conn)
+
+        for kind, table, scoped, has_embedding, _ in tables:
+            row = "row || jsonb_build_object('user_id', %(user_id)s::text)" if scoped else "row"
+            if has_embedding:
+                row = f"CASE WHEN embedding IS NULL THEN {row} ELSE {row} || jsonb_build_object('embedding', embedding) END"
+            cur = await conn.execute(
+                f"""INSERT INTO {table}
+                    SELECT (jsonb_populate_record(NULL::{table}, {row})).* FROM _memu_import WHERE kind = %(kind)s
+                    ON CONFLICT DO NOTHING""",
+                {"user_id": user_id, "kind": kind},
+            )
+            cur2 = await conn.execute("SELECT count(*) AS n FROM _memu_import WHERE kind = %s", (kind,))
+            total = (await cur2.fetchone())["n"]
+            counts[kind] = {"records": total, "inserted": cur.rowcount, "skipped": total - cur.rowcount}
+
+    await _on_user_changed(user_id)
+    return {
+        "user_id": user_id,
+        "source_user_id": header["user_id"],
+        "ids_remapped": remapped,
+        "duration": round(time.time() - started, 2),
+        "tables": counts,
+    }
+
+
+# ===== memU 兼容性检查 =====
+# 本入口依赖 memU 的内部表结构与 MemoryService 参数（不属于其公开 API），基础镜像升级后可能变化；
+# 启动时检查一次，缺失项打印到日志并在 /stats 的 memu_compat 中给出。
+_REQUIRED_COLUMNS = [
+    (items_table, "user_id"),
+    (items_table, "embedding"),
+    (items_table, "summary"),
+    (items_table, "memory_type"),
+    (categories_table, "name"),
+    (category_items_table, "item_id"),
+    (category_items_table, "category_id"),
+    (resources_table, "id"),
+]
+memu_compat: Dict[str, Any] = {"checked": False, "missing": []}
+
+
+def _missing_service_params() -> list:
+    missing = []
+    for method, param in (("memorize", "user"), ("retrieve", "where")):
+        params = inspect.signature(getattr(service, method)).parameters
+        if param not in params and not any(p.kind is p.VAR_KEYWORD for p in params.values()):
+            missing.append(f"MemoryService.{method}({param}=)")
+    return missing
+
+
+async def _check_memu_compat() -> None:
+    missing = _missing_service_params()
+    if database_url:
+        try:
+            pool = await _pg()
+            async with pool.connection() as conn:
+                cur = await conn.execute(
+                    """SELECT table_name, column_name FROM information_schema.columns
+                       WHERE table_schema = current_schema() AND table_name = ANY(%s)""",
+                    (list({table for table, _ in _REQUIRED_COLUMNS}),),
+                )
+                present = {(r["table_name"], r["column_name"]) for r in await cur.fetchall()}
+            missing += [f"{table}.{column}" for table, column in _REQUIRED_COLUMNS if (table, column) not in present]
+        except Exception as exc:
+            missing.append(f"schema check failed: {exc}")
+    memu_compat.update(checked=True, missing=missing)
+    if missing:
+        print(f"⚠️  memU 版本与本入口不兼容，缺少: {', '.join(missing)}")
+
+
 # 对话文件存储目录
 storage_dir = Path(os.getenv("MEMU_STORAGE_DIR", "./data"))
 storage_dir.mkdir(parents=True, exist_ok=True)
@@ -90,12 +1471,20 @@ storage_dir.mkdir(parents=True, exist_ok=True)
 
 @app.post("/memorize")
 async def memorize(payload: Dict[str, Any]):
+    user_id = _payload_user_id(payload)
+    await _check_rate_limit(user_id)
     try:
-        file_path = storage_dir / f"conversation-{uuid.uuid4().hex}.json"
-        with file_path.open("w", encoding="utf-8") as f:
-            json.dump(payload, f, ensure_ascii=False)
+        async with _span("store.conversation_file"):
+            file_path = storage_dir / f"conversation-{uuid.uuid4().hex}.json"
+            with file_path.open("w", encoding="utf-8") as f:
+                json.dump(payload, f, ensure_ascii=False)
 
-        result = await service.memorize(resource_url=str(file_path), modality="conversation")
+        # 不带 user 的请求保持升级前的行为（不写 user_id）
+        scope = {"user": {"user_id": user_id}} if user_id else {}
+        async with _span("memu.memorize", user_id=user_id):
+            result = await service.memorize(resource_url=str(file_path), modality="conversation", **scope)
+        async with _span("cache.invalidate", user_id=user_id):
+            await _on_user_changed(user_id)
         return JSONResponse(content={"status": "success", "result": result})
     except Exception as exc:
         traceback.print_exc()
@@ -106,14 +1495,138 @@ async def memorize(payload: Dict[str, Any]):
 async def retrieve(payload: Dict[str, Any]):
     if "query" not in payload:
         raise HTTPException(status_code=400, detail="Missing 'query' in request body")
+    user_id = _payload_user_id(payload)
+    mode = payload.get("mode", default_retrieve_mode)
+    if mode not in ("memu", "vector", "hybrid"):
+        raise HTTPException(status_code=400, detail=f"Unknown retrieve mode '{mode}'")
+    cache_key = None
+    if retrieve_cache_ttl > 0 and not payload.get("no_cache"):
+        cache_key = _retrieve_cache_key(user_id, await _user_generation(user_id), payload, mode)
+        async with _span("cache.lookup") as attrs:
+            cached = await shared.get(cache_key)
+            attrs["hit"] = cached is not None
+        await shared.incr("memu:stats:rc:hits" if cached else "memu:stats:rc:misses")
+        if cached:
+            return Response(content=cached, media_type="application/json")
+    try:
+        if mode in ("vector", "hybrid"):
+            limit = int(payload.get("limit", 10))
+            [query_vec] = await _embed([payload["query"]])
+            items, mode_used = await _vector_search(
+                user_id,
+                query_vec,
+                limit,
+                payload.get("ef_search"),
+                query=payload["query"] if mode == "hybrid" else None,
+            )
+            result = {"categories": [], "items": items, "mode_used": mode_used}
+        else:
+            async with _span("memu.retrieve", user_id=user_id):
+                scope = {"where": {"user_id": user_id}} if user_id else {}
+                result = await service.retrieve([payload["query"]], **scope)
+        response = JSONResponse(content={"status": "success", "result": result})
+        # hybrid 降级为纯向量的结果不缓存，否则关键词索引就绪后重试仍会拿到降级结果
+        if cache_key and result.get("mode_used", mode) == mode:
+            try:
+                await shared.set(cache_key, response.body.decode("utf-8"), ttl=retrieve_cache_ttl)
+            except Exception:
+                # 缓存写入失败（如 Redis 内存已满且无可淘汰的 key）不影响本次响应
+                traceback.print_exc()
+        return response
+    except Exception as exc:
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(exc))
+
+
+@app.get("/profile/{user_id}")
+async def profile(user_id: str):
     try:
-        result = await service.retrieve([payload["query"]])
+        pool = await _pg()
+        async with pool.connection() as conn:
+            await _ensure_profile_table(conn)
+            cur = await conn.execute(f"SELECT profile FROM {profiles_table} WHERE user_id = %s", (user_id,))
+            row = await cur.fetchone()
+        # 尚未物化（如升级前已有的用户）时现场聚合一次，同样不涉及 embedding / LLM；
+        # 没有记忆的 user_id 返回空画像，不写入画像表
+        result = row["profile"] if row else await _refresh_profile(user_id)
         return JSONResponse(content={"status": "success", "result": result})
     except Exception as exc:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(exc))
 
 
+@app.get("/export/{user_id}")
+async def export_user(user_id: str, gzip: bool = False, dtype: str = "float32"):
+    """流式导出：?gzip=1 压缩，?dtype=float16 向量体积减半（有精度损失）"""
+    if dtype not in ("float32", "float16"):
+        raise HTTPException(status_code=400, detail="dtype must be float32 or float16")
+    lines = _export_lines(user_id, np.dtype(dtype))
+    if gzip:
+        return StreamingResponse(
+            _gzip_stream(lines),
+            media_type="application/gzip",
+            headers={"Content-Disposition": f'attachment; filename="memu-{user_id}.ndjson.gz"'},
+        )
+    return StreamingResponse(lines, media_type="application/x-ndjson")
+
+
+@app.post("/import/{user_id}")
+async def import_user(user_id: str, request: Request):
+    """导入到 user_id（可与导出时不同，此时所有行分配新 id）；按主键去重，已存在的行跳过"""
+    try:
+        result = await _import_user(user_id, request)
+    except (ValueError, KeyError) as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    except Exception as exc:
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(exc))
+    return JSONResponse(content={"status": "success", "result": result})
+
+
+@app.post("/consolidate")
+async def consolidate(payload: Dict[str, Any] | None = None):
+    """手动触发整合：body 可选 {"user_id": "..."}，不传则整合所有用户"""
+    user_id = (payload or {}).get("user_id")
+    try:
+        report = await _run_consolidation([user_id] if user_id else None)
+    except Exception as exc:
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(exc))
+    if report is None:
+        raise HTTPException(status_code=409, detail="Consolidation already running")
+    return JSONResponse(content={"status": "success", "result": report})
+
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def readyz():
+    # 预热由某一个 worker 完成，状态从共享存储读取
+    raw = await shared.get("memu:models")
+    models = json.loads(raw) if raw else model_status
+    # chat fallback 模型不是关键路径（summarize 走 Zhipu），只要求 embedding 就绪
+    ready = models["embed"]["ready"]
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"status": "ready" if ready else "warming", "pid": os.getpid(), "models": models},
+    )
+
+
+@app.get("/stats")
+async def stats():
+    last = await shared.get("memu:consolidate:last")
+    return {
+        "pid": os.getpid(),
+        "hot_tier": hot_tier.stats(),
+        "retrieve_cache": await _retrieve_cache_stats(),
+        "consolidation": json.loads(last) if last else None,
+        "memu_compat": memu_compat,
+    }
+
+
 @app.get("/")
 async def root():
     return {"message": "Hello MemU user!"}
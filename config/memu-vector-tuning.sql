@@ -0,0 +1,105 @@
+-- memU 向量存储调优（可选迁移，不会在容器首次启动时自动执行）
+--
+-- 为所有含 embedding 列的表建立 HNSW 索引（默认半精度 halfvec 表达式索引，索引体积约为 float32 的一半），
+-- 并为 user_id 建 btree 索引，配合 pgvector 0.8 的 iterative scan 做按用户过滤的 ANN 检索。
+--
+-- 用法：
+--   docker compose exec -T memu-postgres psql -U postgres -d memu \
+--     -v precision=halfvec -v m=16 -v ef_construction=64 < config/memu-vector-tuning.sql
+--
+-- 参数（psql -v）：
+--   precision        halfvec（默认）| vector | bit（二值量化，检索时按原始向量重排）
+--                    必须与 memu-server 的 MEMU_VECTOR_PRECISION 一致，否则查询用不上索引
+--   m                HNSW 每层最大连接数，默认 16（越大召回越高、索引越大）
+--   ef_construction  建索引时的候选列表大小，默认 64（越大召回越高、建索引越慢）
+--   dims             向量维度，默认 768（nomic-embed-text）
+--   store_half       1 = 把 embedding 列本身改为 halfvec 存储（表数据也减半，不可逆），默认 0；
+--                    只能与 precision=halfvec 一起使用
+--   backfill_user    把 user_id 为空的旧数据（升级前不带用户范围写入的记忆）归到该用户，默认不回填
+--
+-- 行为变化：升级后按用户检索（where.user_id）、热用户层、画像、导出与整合都只看 user_id 匹配的行，
+-- 升级前写入的记忆 user_id 为空，只有不带 where 的检索还能查到。单用户实例可用 backfill_user 一次性归属：
+--   docker compose exec -T memu-postgres psql -U postgres -d memu \
+--     -v backfill_user=dolores < config/memu-vector-tuning.sql
+--
+-- 查询时的 ef_search 由 memu-server 的 MEMU_HNSW_EF_SEARCH 或 /retrieve 请求体的 ef_search 控制。
+
+\set ON_ERROR_STOP on
+
+\if :{?precision}
+\else
+\set precision halfvec
+\endif
+\if :{?m}
+\else
+\set m 16
+\endif
+\if :{?ef_construction}
+\else
+\set ef_construction 64
+\endif
+\if :{?dims}
+\else
+\set dims 768
+\endif
+\if :{?store_half}
+\else
+\set store_half 0
+\endif
+
+-- store_half 只能配合 halfvec：列转为 halfvec 后，vector / bit 的索引与 memu-server 查询中的 ::vector 比较都无法使用
+SELECT (:'store_half' <> '0' AND :'precision' <> 'halfvec') AS store_half_conflict \gset
+\if :store_half_conflict
+\echo 'store_half=1 只能与 precision=halfvec 一起使用（当前 precision=' :precision '），未做任何修改'
+\quit
+\endif
+
+-- halfvec 需要 pgvector >= 0.7，iterative scan 需要 >= 0.8
+CREATE EXTENSION IF NOT EXISTS vector;
+ALTER EXTENSION vector UPDATE;
+
+-- 1. （可选）将 embedding 列转为 halfvec 存储
+\if :store_half
+SELECT format('ALTER TABLE %I.%I ALTER COLUMN embedding TYPE halfvec(%s) USING embedding::halfvec(%s)',
+              c.table_schema, c.table_name, :'dims', :'dims')
+FROM information_schema.columns c
+WHERE c.table_schema = 'public' AND c.column_name = 'embedding' AND c.udt_name = 'vector'
+\gexec
+\endif
+
+-- 1b. （可选）回填旧数据的 user_id
+\if :{?backfill_user}
+SELECT format('UPDATE %I.%I SET user_id = %L WHERE user_id IS NULL',
+              c.table_schema, c.table_name, :'backfill_user')
+FROM information_schema.columns c
+WHERE c.table_schema = 'public' AND c.column_name = 'user_id'
+\gexec
+\endif
+
+-- 2. 删除本脚本此前建立的 HNSW 索引（参数变更后重建）
+SELECT format('DROP INDEX IF EXISTS %I.%I', schemaname, indexname)
+FROM pg_indexes
+WHERE schemaname = 'public' AND indexname LIKE '%\_embedding\_hnsw'
+\gexec
+
+-- 3. 建 HNSW 索引；表达式必须与 memu-server 查询中的表达式完全一致
+SELECT format('CREATE INDEX %I ON %I.%I USING hnsw (%s) WITH (m = %s, ef_construction = %s)',
+              c.table_name || '_embedding_hnsw', c.table_schema, c.table_name,
+              CASE :'precision'
+                  WHEN 'vector'  THEN 'embedding vector_cosine_ops'
+                  WHEN 'bit'     THEN format('(binary_quantize(embedding)::bit(%s)) bit_hamming_ops', :'dims')
+                  ELSE                format('(embedding::halfvec(%s)) halfvec_cosine_ops', :'dims')
+              END,
+              :'m', :'ef_construction')
+FROM information_schema.columns c
+WHERE c.table_schema = 'public' AND c.column_name = 'embedding'
+\gexec
+
+-- 4. 按用户过滤的 btree 索引
+SELECT format('CREATE INDEX IF NOT EXISTS %I ON %I.%I (user_id)',
+              c.table_name || '_user_id_idx', c.table_schema, c.table_name)
+FROM information_schema.columns c
+WHERE c.table_schema = 'public' AND c.column_name = 'user_id'
+\gexec
+
+ANALYZE;
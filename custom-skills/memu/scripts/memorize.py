@@ -6,6 +6,7 @@ memU 记忆存储脚本
 
 import argparse
 import json
+import re
 import sys
 import urllib.request
 import urllib.error
@@ -15,6 +16,13 @@ from datetime import datetime
 MEMU_API_URL = os.environ.get("MEMU_API_URL", "http://memu-server:8000")
 
 
+def traceparent() -> str:
+    """W3C traceparent：沿用环境变量 TRACEPARENT 中的 trace id（由上游传入），否则新建"""
+    match = re.match(r"^00-([0-9a-f]{32})-[0-9a-f]{16}-[0-9a-f]{2}$", os.environ.get("TRACEPARENT", ""))
+    trace_id = match.group(1) if match else os.urandom(16).hex()
+    return f"00-{trace_id}-{os.urandom(8).hex()}-01"
+
+
 def memorize(user_id: str, messages: list) -> dict:
     """存储对话到 memU"""
     # 构造 memU 格式的 payload
@@ -33,12 +41,15 @@ def memorize(user_id: str, messages: list) -> dict:
     }
 
     data = json.dumps(payload).encode("utf-8")
+    tp = traceparent()
     req = urllib.request.Request(
         f"{MEMU_API_URL}/memorize",
         data=data,
-        headers={"Content-Type": "application/json"},
+        headers={"Content-Type": "application/json", "traceparent": tp},
         method="POST"
     )
+    # trace id 输出到 stderr，便于与 memU-server 的 trace 文件对应
+    print(f"🔎 trace_id: {tp.split('-')[1]}", file=sys.stderr)
 
     try:
         with urllib.request.urlopen(req, timeout=30) as resp:
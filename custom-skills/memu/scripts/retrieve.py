@@ -1,34 +1,60 @@
 #!/usr/bin/env python3
 """
 memU 记忆检索脚本
-调用 memU-server 的 /retrieve API 检索相关记忆
+调用 memU-server 的 /retrieve API 检索相关记忆，或通过 /profile 获取用户画像
 """
 
 import argparse
 import json
+import re
 import sys
 import urllib.request
 import urllib.error
 import os
+from urllib.parse import quote
 
 MEMU_API_URL = os.environ.get("MEMU_API_URL", "http://memu-server:8000")
 
 
-def retrieve(user_id: str, query: str) -> dict:
+def traceparent() -> str:
+    """W3C traceparent：沿用环境变量 TRACEPARENT 中的 trace id（由上游传入），否则新建"""
+    match = re.match(r"^00-([0-9a-f]{32})-[0-9a-f]{16}-[0-9a-f]{2}$", os.environ.get("TRACEPARENT", ""))
+    trace_id = match.group(1) if match else os.urandom(16).hex()
+    return f"00-{trace_id}-{os.urandom(8).hex()}-01"
+
+
+def retrieve(user_id: str, query: str, mode: str | None = None) -> dict:
     """从 memU 检索相关记忆"""
     payload = {
         "query": query,
         "where": {"user_id": user_id}
     }
+    if mode:
+        payload["mode"] = mode
 
     data = json.dumps(payload).encode("utf-8")
     req = urllib.request.Request(
         f"{MEMU_API_URL}/retrieve",
         data=data,
-        headers={"Content-Type": "application/json"},
+        headers={"Content-Type": "application/json", "traceparent": traceparent()},
         method="POST"
     )
+    return _send(req)
+
+
+def profile(user_id: str) -> dict:
+    """获取 memU 预先物化的用户画像（不触发 embedding / LLM）"""
+    req = urllib.request.Request(
+        f"{MEMU_API_URL}/profile/{quote(user_id, safe='')}",
+        headers={"traceparent": traceparent()},
+        method="GET"
+    )
+    return _send(req)
 
+
+def _send(req: urllib.request.Request) -> dict:
+    # trace id 输出到 stderr，便于与 memU-server 的 trace 文件对应
+    print(f"🔎 trace_id: {req.get_header('Traceparent').split('-')[1]}", file=sys.stderr)
     try:
         with urllib.request.urlopen(req, timeout=30) as resp:
             result = json.loads(resp.read().decode("utf-8"))
@@ -40,21 +66,54 @@ def retrieve(user_id: str, query: str) -> dict:
         return {"error": f"连接失败: {e.reason}"}
 
 
+def print_profile(data: dict):
+    categories = data.get("categories", [])
+    facts = data.get("facts", [])
+    if not facts and not categories:
+        print("ℹ️ 暂无该用户的记忆画像")
+    else:
+        print(f"👤 共 {data.get('memory_count', len(facts))} 条记忆")
+        if categories:
+            names = ", ".join(f"{c['name']}({c['count']})" for c in categories)
+            print(f"📂 主要分类: {names}")
+        if facts:
+            print("📝 关键事实:")
+            for i, fact in enumerate(facts, 1):
+                print(f"  {i}. {fact.get('summary', '')}")
+
+    print("\n--- 原始数据 ---")
+    print(json.dumps(data, indent=2, ensure_ascii=False))
+
+
 def main():
     parser = argparse.ArgumentParser(description="memU 记忆检索")
     parser.add_argument("--user-id", required=True, help="机器人 ID（如 dolores）")
-    parser.add_argument("--query", required=True, help="检索关键词或问题")
+    parser.add_argument("--query", help="检索关键词或问题")
+    parser.add_argument("--profile", action="store_true",
+                        help="获取用户画像（主要分类 + 关键事实），适合新 session 开始时使用")
+    parser.add_argument("--mode", choices=["memu", "vector", "hybrid"],
+                        help="检索模式（默认由服务端决定）；hybrid 适合精确名称、SKU 等关键词")
     args = parser.parse_args()
 
-    result = retrieve(args.user_id, args.query)
+    if not args.profile and not args.query:
+        parser.error("需要 --query 或 --profile")
+
+    result = profile(args.user_id) if args.profile else retrieve(args.user_id, args.query, args.mode)
 
     if "error" in result:
         print(f"❌ {result['error']}", file=sys.stderr)
         sys.exit(1)
 
-    # 格式化输出记忆内容
-    items = result.get("items", [])
-    categories = result.get("categories", [])
+    if args.profile:
+        print_profile(result.get("result", result))
+        return
+
+    # 格式化输出记忆内容（服务端返回 {"status": ..., "result": {...}}）
+    data = result.get("result", result)
+    if args.mode == "hybrid" and data.get("mode_used") == "vector":
+        print("⚠️ 该用户的关键词索引尚未就绪，本次只有向量检索结果", file=sys.stderr)
+    items = data.get("items", [])
+    categories = data.get("categories", [])
 
     if not items and not categories:
         print("ℹ️ 未找到相关记忆")
@@ -64,7 +123,7 @@ def main():
         if items:
             print(f"📝 找到 {len(items)} 条相关记忆:")
             for i, item in enumerate(items, 1):
-                text = item.get("content", item.get("text", str(item)))
+                text = item.get("summary") or item.get("content") or item.get("text") or str(item)
                 print(f"  {i}. {text}")
 
     # 同时输出原始 JSON 供 agent 解析
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+memU-server 压测脚本
+并发调用 /retrieve（或 /memorize），输出吞吐量与延迟分位数，用于对比不同 MEMU_WORKERS 下的表现
+
+用法:
+  python3 scripts/memu-bench.py --concurrency 16 --requests 400
+  MEMU_WORKERS=1 docker compose up -d memu-server && python3 scripts/memu-bench.py
+  MEMU_WORKERS=4 docker compose up -d memu-server && python3 scripts/memu-bench.py
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+MEMU_API_URL = os.environ.get("MEMU_API_URL", "http://localhost:8000")
+
+
+def call(url: str, payload: dict, timeout: float) -> tuple[float, bool]:
+    data = json.dumps(payload).encode("utf-8")
+    req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"}, method="POST")
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            resp.read()
+            ok = resp.status == 200
+    except (urllib.error.URLError, TimeoutError):
+        ok = False
+    return time.perf_counter() - start, ok
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[k]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="memU-server 压测")
+    parser.add_argument("--url", default=MEMU_API_URL, help="memU-server 地址")
+    parser.add_argument("--endpoint", default="retrieve", choices=["retrieve", "memorize"])
+    parser.add_argument("--concurrency", type=int, default=16, help="并发数")
+    parser.add_argument("--requests", type=int, default=200, help="总请求数")
+    parser.add_argument("--user-count", type=int, default=8, help="模拟的用户数（请求轮流分配）")
+    parser.add_argument("--query", default="用户的偏好是什么", help="retrieve 查询内容")
+    parser.add_argument("--cache", action="store_true",
+                        help="retrieve 走检索结果缓存（默认带 no_cache 绕过缓存，测的是 worker 的实际检索吞吐）")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    args = parser.parse_args()
+
+    def payload(i: int) -> dict:
+        user_id = f"bench-{i % args.user_count}"
+        if args.endpoint == "retrieve":
+            return {"query": args.query, "where": {"user_id": user_id}, "no_cache": not args.cache}
+        return {
+            "content": [{"role": "user", "content": {"text": f"压测消息 {i}"}, "created_at": "2026-01-01 00:00:00"}],
+            "user": {"user_id": user_id},
+        }
+
+    url = f"{args.url}/{args.endpoint}"
+    cache = f" cache={'on' if args.cache else 'off'}" if args.endpoint == "retrieve" else ""
+    print(f"⏱  {url}  concurrency={args.concurrency} requests={args.requests}{cache}")
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(lambda i: call(url, payload(i), args.timeout), range(args.requests)))
+    elapsed = time.perf_counter() - started
+
+    latencies = [lat for lat, ok in results if ok]
+    failed = len(results) - len(latencies)
+    if not latencies:
+        print("❌ 所有请求均失败", file=sys.stderr)
+        sys.exit(1)
+
+    print(f"✅ 成功 {len(latencies)} / 失败 {failed}，耗时 {elapsed:.2f}s")
+    print(f"   吞吐量: {len(latencies) / elapsed:.1f} req/s")
+    print(
+        f"   延迟: mean={statistics.mean(latencies) * 1000:.0f}ms "
+        f"p50={percentile(latencies, 50) * 1000:.0f}ms "
+        f"p95={percentile(latencies, 95) * 1000:.0f}ms "
+        f"p99={percentile(latencies, 99) * 1000:.0f}ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
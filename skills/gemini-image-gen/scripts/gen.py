@@ -3,16 +3,18 @@
 
 使用 gemini-3-pro-image 模型，通过 /v1/chat/completions 端点生成图片，
 从响应 content 中提取 base64 编码的图片数据。
+同一 prompt 生成多张时，单次请求通过 n 参数要求多个候选；所有请求复用同一个 keep-alive 连接。
 """
 import argparse
 import base64
 import datetime as dt
+import http.client
 import json
 import os
 import random
 import re
 import sys
-import urllib.error
+import urllib.parse
 import urllib.request
 from pathlib import Path
 
@@ -71,23 +73,25 @@ def pick_prompts(count: int) -> list[str]:
     return prompts
 
 
-def extract_base64_image(content: str) -> bytes | None:
-    """从 Chat Completions 响应内容中提取 base64 图片数据。
+def extract_base64_images(content: str) -> list[bytes]:
+    """从 Chat Completions 响应内容中提取所有 base64 图片数据。
 
     Gemini 返回的图片数据格式：
-    1. data:image/xxx;base64,<data> (内嵌 data URI)
+    1. data:image/xxx;base64,<data> (内嵌 data URI，可能有多个)
     2. 超长的 base64 字符串
     """
     if not content:
-        return None
+        return []
 
     # 尝试提取 data URI 中的 base64 数据
-    if "base64," in content:
-        b64_str = content.split("base64,")[1].split('"')[0].split(")")[0].strip()
+    images: list[bytes] = []
+    for b64_str in re.findall(r"base64,([A-Za-z0-9+/=\s]+)", content):
         try:
-            return base64.b64decode(b64_str)
+            images.append(base64.b64decode(re.sub(r"\s", "", b64_str)))
         except Exception:
             pass
+    if images:
+        return images
 
     # 尝试直接作为 base64 解码（超长内容）
     if len(content) > 1000:
@@ -95,51 +99,147 @@ def extract_base64_image(content: str) -> bytes | None:
         cleaned = re.sub(r'[^A-Za-z0-9+/=]', '', content)
         if len(cleaned) > 500:
             try:
-                return base64.b64decode(cleaned)
+                return [base64.b64decode(cleaned)]
             except Exception:
                 pass
 
-    return None
+    return []
+
+
+def extract_base64_image(content: str) -> bytes | None:
+    """从响应内容中提取第一张图片。"""
+    images = extract_base64_images(content)
+    return images[0] if images else None
+
+
+class GeminiClient:
+    """复用同一个 keep-alive 连接的 Chat Completions 客户端。
+
+    脚本按顺序发请求，一个持久连接即可省掉每张图的 TCP/TLS 握手；
+    连接被代理关闭时自动重连一次。与 urllib 一样遵循 HTTP(S)_PROXY / NO_PROXY 环境变量，
+    HTTPS 经代理时用 CONNECT 隧道。
+    """
+
+    def __init__(self, api_key: str, base_url: str, timeout: float = 300):
+        parsed = urllib.parse.urlsplit(base_url)
+        self.api_key = api_key
+        self.https = parsed.scheme == "https"
+        self.host = parsed.netloc
+        self.path = parsed.path.rstrip("/")
+        self.timeout = timeout
+        self.conn: http.client.HTTPConnection | None = None
+        self.proxy = None
+        proxy_url = urllib.request.getproxies().get(parsed.scheme)
+        if proxy_url and not urllib.request.proxy_bypass(parsed.hostname or ""):
+            if "://" not in proxy_url:
+                proxy_url = f"http://{proxy_url}"
+            self.proxy = urllib.parse.urlsplit(proxy_url)
+        # 经 HTTP 代理访问 http:// 地址时请求行必须用完整 URL
+        self.prefix = f"{parsed.scheme}://{self.host}" if self.proxy and not self.https else ""
+        # 代理是否支持 n>1 一次返回多个候选；None 表示尚未探测
+        self.multi_candidates: bool | None = None
+
+    def _proxy_port(self) -> int:
+        # 与 urllib 一致：代理 URL 未写端口时用其协议的默认端口
+        return self.proxy.port or (443 if self.proxy.scheme == "https" else 80)
+
+    def _proxy_headers(self) -> dict:
+        if not self.proxy.username:
+            return {}
+        userinfo = urllib.parse.unquote(self.proxy.username) + ":" + urllib.parse.unquote(self.proxy.password or "")
+        return {"Proxy-Authorization": "Basic " + base64.b64encode(userinfo.encode("utf-8")).decode("ascii")}
+
+    def _connect(self) -> http.client.HTTPConnection:
+        if self.conn is None:
+            cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            if self.proxy is None:
+                self.conn = cls(self.host, timeout=self.timeout)
+            elif self.https:
+                # 先连代理并发 CONNECT，隧道建立后再与目标做 TLS 握手
+                self.conn = cls(self.proxy.hostname, self._proxy_port(), timeout=self.timeout)
+                self.conn.set_tunnel(self.host, headers=self._proxy_headers())
+            else:
+                self.conn = http.client.HTTPConnection(
+                    self.proxy.hostname, self._proxy_port(), timeout=self.timeout
+                )
+        return self.conn
+
+    def close(self) -> None:
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def post_json(self, path: str, payload: dict) -> tuple[int, bytes]:
+        body = json.dumps(payload).encode("utf-8")
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+            "Connection": "keep-alive",
+        }
+        if self.proxy is not None and not self.https:
+            headers.update(self._proxy_headers())
+        for attempt in range(2):
+            conn = self._connect()
+            try:
+                conn.request("POST", f"{self.prefix}{self.path}{path}", body=body, headers=headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except (http.client.RemoteDisconnected, http.client.CannotSendRequest,
+                    ConnectionResetError, BrokenPipeError):
+                # 空闲连接被服务端关闭，重连后重试一次
+                self.close()
+                if attempt:
+                    raise
+                continue
+            if resp.will_close:
+                self.close()
+            return resp.status, data
+        raise RuntimeError("unreachable")
 
 
 def request_image(
-    api_key: str,
-    base_url: str,
+    client: GeminiClient,
     prompt: str,
     model: str = "gemini-3-pro-image",
-) -> bytes:
-    """通过 Chat Completions API 请求生成图片，返回图片二进制数据。"""
-    url = f"{base_url}/chat/completions"
-    body = json.dumps({
+    n: int = 1,
+) -> list[bytes]:
+    """通过 Chat Completions API 请求生成图片，返回图片二进制数据列表。
+
+    n>1 时在一次请求中要求多个候选，返回的图片可能少于 n（代理不支持时只有 1 张）。
+    """
+    payload = {
         "model": model,
         "messages": [{"role": "user", "content": f"Generate an image: {prompt}"}],
         "max_tokens": 8192,
-    }).encode("utf-8")
+    }
+    if n > 1:
+        payload["n"] = n
 
-    req = urllib.request.Request(
-        url,
-        method="POST",
-        headers={
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json",
-        },
-        data=body,
-    )
-    try:
-        with urllib.request.urlopen(req, timeout=300) as resp:
-            result = json.loads(resp.read().decode("utf-8"))
-    except urllib.error.HTTPError as e:
-        payload = e.read().decode("utf-8", errors="replace")
-        raise RuntimeError(f"Gemini Images API failed ({e.code}): {payload}") from e
-
-    content = result.get("choices", [{}])[0].get("message", {}).get("content", "")
-    image_data = extract_base64_image(content)
-    if not image_data:
+    status, data = client.post_json("/chat/completions", payload)
+    if status >= 400:
+        text = data.decode("utf-8", errors="replace")
+        if n > 1 and status in (400, 422):
+            # 代理拒绝 n 参数：记下来，退回单图请求
+            client.multi_candidates = False
+            return request_image(client, prompt, model)
+        raise RuntimeError(f"Gemini Images API failed ({status}): {text}")
+    result = json.loads(data.decode("utf-8"))
+
+    images: list[bytes] = []
+    contents: list[str] = []
+    for choice in result.get("choices") or [{}]:
+        content = choice.get("message", {}).get("content") or ""
+        contents.append(content)
+        images.extend(extract_base64_images(content))
+    if not images:
+        content = contents[0] if contents else ""
         raise RuntimeError(
             f"No image data in response. Content length: {len(content)}, "
             f"preview: {content[:200]}"
         )
-    return image_data
+    if n > 1:
+        client.multi_candidates = len(images) > 1
+    return images[:n]
 
 
 def write_gallery(out_dir: Path, items: list[dict]) -> None:
@@ -181,6 +281,7 @@ def main() -> int:
     ap = argparse.ArgumentParser(description="通过 Gemini 代理生成图片。")
     ap.add_argument("--prompt", help="图片提示词。不指定则随机生成。")
     ap.add_argument("--count", type=int, default=1, help="生成图片数量（默认 1）。")
+    ap.add_argument("--batch", type=int, default=4, help="同一 prompt 单次请求的候选图片数（默认 4，代理不支持时自动退回 1）。")
     ap.add_argument("--model", default="gemini-3-pro-image", help="图片模型 ID。")
     ap.add_argument("--out-dir", default="", help="输出目录。")
     args = ap.parse_args()
@@ -197,21 +298,39 @@ def main() -> int:
     out_dir = Path(args.out_dir).expanduser() if args.out_dir else default_out_dir()
     out_dir.mkdir(parents=True, exist_ok=True)
 
-    prompts = [args.prompt] * args.count if args.prompt else pick_prompts(args.count)
+    client = GeminiClient(api_key, base_url)
+    # 指定 prompt 时同一 prompt 出多张，可以合并成多候选请求；随机 prompt 每张各不相同
+    if args.prompt:
+        jobs = [(args.prompt, args.count)]
+    else:
+        jobs = [(prompt, 1) for prompt in pick_prompts(args.count)]
 
     items: list[dict] = []
-    for idx, prompt in enumerate(prompts, start=1):
-        print(f"[{idx}/{len(prompts)}] {prompt}")
-        try:
-            image_data = request_image(api_key, base_url, prompt, args.model)
-            filename = f"{idx:03d}-{slugify(prompt)[:40]}.png"
-            filepath = out_dir / filename
-            filepath.write_bytes(image_data)
-            items.append({"prompt": prompt, "file": filename})
-            print(f"  ✅ saved: {filename} ({len(image_data)} bytes)")
-        except Exception as e:
-            print(f"  ❌ failed: {e}", file=sys.stderr)
-            continue
+    idx = 0
+    try:
+        for prompt, remaining in jobs:
+            while remaining > 0:
+                # 只拿回一张说明代理不支持多候选，之后改为单图请求
+                n = min(remaining, max(1, args.batch)) if client.multi_candidates is not False else 1
+                remaining -= n
+                print(f"[{idx + 1}/{args.count}] {prompt}" + (f" (×{n})" if n > 1 else ""))
+                try:
+                    images = request_image(client, prompt, args.model, n)
+                except Exception as e:
+                    idx += n
+                    print(f"  ❌ failed: {e}", file=sys.stderr)
+                    continue
+                # 少拿到的几张放回待生成数量
+                remaining += n - len(images)
+                for image_data in images:
+                    idx += 1
+                    filename = f"{idx:03d}-{slugify(prompt)[:40]}.png"
+                    filepath = out_dir / filename
+                    filepath.write_bytes(image_data)
+                    items.append({"prompt": prompt, "file": filename})
+                    print(f"  ✅ saved: {filename} ({len(image_data)} bytes)")
+    finally:
+        client.close()
 
     if items:
         (out_dir / "prompts.json").write_text(